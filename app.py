@@ -18,10 +18,15 @@ from streamlit_common import setup_for_azure, \
                              load_data, \
                              setup_log_storage, \
                              write_global_data_to_blob, \
-                             write_session_data_to_blob
+                             write_session_data_to_blob, \
+                             load_embedding_cache, \
+                             load_answer_cache
 
 import logging
 from logging_config import setup_logging
+from gdpr_rag.section_cache import section_cache
+from gdpr_rag.token_counts import token_counter
+from gdpr_rag.single_flight import single_flight
 DEV_LEVEL = 15
 ANALYSIS_LEVEL = 25
 logging.addLevelName(DEV_LEVEL, 'DEV')       
@@ -49,6 +54,11 @@ if 'user_id' not in st.session_state:
         st.session_state['user_id'] = date_time_str
         st.session_state['blob_name_for_session_logs'] = date_time_str + "_user_id.log"
         logger.log(ANALYSIS_LEVEL, f"New session for user {st.session_state['user_id']}")
+        section_cache.log_stats()
+        token_counter.log_stats()
+        single_flight.log_stats()
+        load_embedding_cache().log_stats()
+        load_answer_cache().log_stats()
 
 try:
     
@@ -0,0 +1,294 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError
+from azure.storage.blob import BlobType, ContentSettings
+
+try:
+    import fcntl
+except ImportError:
+    # Windows. Ships are then not locked against other processes, which only matters with several workers on a Linux host
+    fcntl = None
+
+DEV_LEVEL = 15
+ANALYSIS_LEVEL = 25
+logging.addLevelName(DEV_LEVEL, 'DEV')
+logging.addLevelName(ANALYSIS_LEVEL, 'ANALYSIS')
+
+logger = logging.getLogger(__name__)
+
+# Azure append blobs take at most 4 MiB per append_block call
+max_block_bytes = 4 * 1024 * 1024
+
+
+def create_append_blob_if_missing(blob_client):
+    '''
+    Creates an empty append blob unless the blob already exists, in one round trip. Returns True if it was created
+    '''
+    try:
+        blob_client.create_append_blob(content_settings = ContentSettings(content_type = 'text/plain'), match_condition = MatchConditions.IfMissing)
+        return True
+    except (ResourceExistsError, ResourceModifiedError):
+        return False
+
+
+class BlobLogWriter:
+    '''
+    Appends text to Azure append blobs from a background thread so that page interactions never wait on blob storage.
+
+    append() only puts the text on a bounded queue. The worker batches the text per blob and writes a blob when it
+    has flush_bytes waiting, when its oldest text has waited flush_interval seconds, and at shutdown. The append
+    blob is created by the first write to it, so nothing goes to blob storage for a session that never logs. Text
+    that does not fit on the queue is dropped and counted, as are appends that fail.
+    '''
+    def __init__(self, max_queue = 10000, flush_bytes = 64 * 1024, flush_interval = 5.0):
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize = max_queue)
+        self._pending = {} # blob name -> [blob_client, list of text, bytes, time of the oldest text]
+        self._created = set() # names of the blobs that are known to exist. Only used by the worker
+        self._lock = threading.Lock()
+        self.dropped = 0
+        self.failed = 0
+        self.written = 0
+        self._worker = threading.Thread(target = self._run, name = "blob_log_writer", daemon = True)
+        self._worker.start()
+        atexit.register(self.close)
+
+    def append(self, blob_client, text):
+        try:
+            self._queue.put_nowait((blob_client, text))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                dropped = self.dropped
+            # Only the first drop and every 100th after that: once the queue is full there will be many
+            if dropped == 1 or dropped % 100 == 0:
+                logger.warning(f"Blob log queue is full. {dropped} log entries dropped so far")
+
+    def _run(self):
+        while True:
+            timeout = self._time_to_next_flush()
+            try:
+                item = self._queue.get(timeout = timeout)
+            except queue.Empty:
+                item = None
+            if item is not None and item[0] is None: # close()
+                self._flush(force = True)
+                self._queue.task_done()
+                return
+            if item is not None:
+                blob_client, text = item
+                entry = self._pending.setdefault(blob_client.blob_name, [blob_client, [], 0, time.monotonic()])
+                entry[1].append(text)
+                entry[2] += len(text.encode("utf-8"))
+                self._queue.task_done()
+            self._flush()
+
+    def _time_to_next_flush(self):
+        if not self._pending:
+            return None
+        oldest = min(entry[3] for entry in self._pending.values())
+        return max(0.0, oldest + self.flush_interval - time.monotonic())
+
+    def _flush(self, force = False):
+        now = time.monotonic()
+        for blob_name in list(self._pending):
+            blob_client, texts, size, oldest = self._pending[blob_name]
+            if force or size >= self.flush_bytes or now - oldest >= self.flush_interval:
+                del self._pending[blob_name]
+                self._write(blob_client, "".join(texts).encode("utf-8"))
+
+    def _write(self, blob_client, data):
+        try:
+            if blob_client.blob_name not in self._created:
+                create_append_blob_if_missing(blob_client)
+                self._created.add(blob_client.blob_name)
+            for start in range(0, len(data), max_block_bytes):
+                blob_client.append_block(data[start:start + max_block_bytes])
+            with self._lock:
+                self.written += 1
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            logger.error(f"Could not append {len(data)} bytes to blob {blob_client.blob_name}: {e}")
+
+    def flush(self):
+        '''
+        Blocks until everything appended so far has been picked up by the worker (not necessarily written)
+        '''
+        self._queue.join()
+
+    def close(self, timeout = 10.0):
+        if self._worker.is_alive():
+            try:
+                self._queue.put((None, None), timeout = timeout)
+            except queue.Full:
+                logger.error(f"Blob log queue is still full at shutdown. {self._queue.qsize()} entries not written")
+                return
+            self._worker.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {"written": self.written, "failed": self.failed, "dropped": self.dropped, "queued": self._queue.qsize()}
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.log(ANALYSIS_LEVEL, f"Blob log writer: {stats['written']} batches written, {stats['failed']} failed, {stats['dropped']} entries dropped, {stats['queued']} queued")
+
+
+class LogFileShipper:
+    '''
+    Ships a log file written by a RotatingFileHandler to an Azure append blob, a piece at a time, from a background
+    thread. Each ship() appends only the complete lines written since the last one.
+
+    When the handler rotates the file, the lines that had not been shipped yet are taken from the backup (path + ".1")
+    before the new file is shipped from its start. If the file rotates twice between ships, the lines in between are lost.
+
+    Every app process on a host logs to the same file and has its own shipper. The offset that has been shipped is
+    kept next to the file (path + ".shipped") and only read and moved on while holding a lock on path + ".ship.lock",
+    so each line is shipped once, by whichever process gets there first.
+    '''
+    def __init__(self, path, blob_client, min_interval = 10.0):
+        self.path = path
+        self.blob_client = blob_client
+        # Every ship is one more block on the blob (at most 50000), so there is at least this long between ships
+        self.min_interval = min_interval
+        self.state_path = path + ".shipped"
+        self.lock_path = path + ".ship.lock"
+        self._offset = 0
+        self._inode = None
+        self._blob_ready = False
+        self._wake = threading.Event()
+        self._closing = threading.Event()
+        self._lock = threading.Lock()
+        self.shipped_bytes = 0
+        self.rotations = 0
+        self.failed = 0
+        self._worker = threading.Thread(target = self._run, name = "log_file_shipper", daemon = True)
+        self._worker.start()
+        atexit.register(self.close)
+
+    def ship(self):
+        # Returns at once. The worker picks it up after min_interval at the latest
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            self._ship_new_lines()
+            if self._closing.wait(self.min_interval):
+                self._ship_new_lines()
+                return
+
+    def _prepare_blob(self):
+        if not create_append_blob_if_missing(self.blob_client):
+            # Never replaced: it may hold log history
+            if self.blob_client.get_blob_properties().blob_type != BlobType.APPENDBLOB:
+                raise ValueError(f"{self.blob_client.blob_name} exists and is not an append blob")
+        self._blob_ready = True
+
+    def _read_state(self):
+        try:
+            with open(self.state_path, "r", encoding = "utf-8") as state_file:
+                state = json.load(state_file)
+            self._inode, self._offset = state["inode"], state["offset"]
+        except (FileNotFoundError, ValueError, KeyError):
+            self._inode, self._offset = None, 0
+
+    def _write_state(self):
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w", encoding = "utf-8") as state_file:
+            json.dump({"inode": self._inode, "offset": self._offset}, state_file)
+        os.replace(tmp_path, self.state_path)
+
+    def _ship_new_lines(self):
+        if not self._blob_ready:
+            try:
+                self._prepare_blob()
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                logger.error(f"Could not create the append blob {self.blob_client.blob_name}: {e}")
+                return
+        with open(self.lock_path, "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._read_state()
+                try:
+                    inode = os.stat(self.path).st_ino
+                except FileNotFoundError:
+                    return
+                if self._inode is not None and inode != self._inode:
+                    self._ship_rotated_lines()
+                    self._offset = 0
+                self._inode = inode
+                self._ship_from(self.path, inode, complete_lines_only = True)
+                self._write_state()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _ship_rotated_lines(self):
+        with self._lock:
+            self.rotations += 1
+        backup = self.path + ".1"
+        try:
+            backup_inode = os.stat(backup).st_ino
+        except FileNotFoundError:
+            backup_inode = None
+        if backup_inode != self._inode:
+            logger.warning(f"{self.path} rotated more than once between ships. Some of its lines were not shipped")
+            return
+        # Nothing more is written to the backup, so the last line is complete as well
+        self._ship_from(backup, backup_inode, complete_lines_only = False)
+
+    def _ship_from(self, path, inode, complete_lines_only):
+        try:
+            with open(path, "rb") as log_file:
+                if os.fstat(log_file.fileno()).st_ino != inode: # rotated since the stat
+                    return
+                if os.fstat(log_file.fileno()).st_size < self._offset: # the file was cleared
+                    self._offset = 0
+                log_file.seek(self._offset)
+                data = log_file.read()
+        except FileNotFoundError:
+            return
+        if complete_lines_only:
+            data = data[:data.rfind(b"\n") + 1]
+        if not data:
+            return
+        try:
+            for start in range(0, len(data), max_block_bytes):
+                self.blob_client.append_block(data[start:start + max_block_bytes])
+        except Exception as e:
+            # The offset is not moved on so these lines go with the next ship
+            with self._lock:
+                self.failed += 1
+            logger.error(f"Could not append {len(data)} bytes of {path} to blob {self.blob_client.blob_name}: {e}")
+            return
+        self._offset += len(data)
+        with self._lock:
+            self.shipped_bytes += len(data)
+
+    def close(self, timeout = 10.0):
+        if self._worker.is_alive():
+            self._closing.set()
+            self._wake.set()
+            self._worker.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {"shipped_bytes": self.shipped_bytes, "rotations": self.rotations, "failed": self.failed}
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.log(ANALYSIS_LEVEL, f"Global log shipper: {stats['shipped_bytes']} bytes shipped, {stats['rotations']} rotations, {stats['failed']} failed")
@@ -0,0 +1,86 @@
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+ANALYSIS_LEVEL = 25
+logging.addLevelName(ANALYSIS_LEVEL, 'ANALYSIS')
+
+default_max_entries = 512
+# Cosine distance between two standalone questions below which they are treated as the same question
+default_max_distance = 0.03
+
+
+class AnswerCache:
+    '''
+    Process-wide, bounded cache of generated answers for near-duplicate standalone questions.
+
+    An entry is only served when the new question's embedding is within max_distance of a cached question AND the
+    retrieved definitions and sections are exactly the same set, with the same strict_rag setting, so the model
+    would have been given the same context. Everything is dropped when the index version changes.
+    '''
+    def __init__(self, max_entries = default_max_entries, max_distance = default_max_distance):
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self._entries = OrderedDict() # (retrieved_set, strict_rag) -> list of [unit embedding, answer]
+        self._size = 0
+        self._index_version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _check_version(self, index_version):
+        if index_version != self._index_version:
+            if self._size:
+                logger.log(ANALYSIS_LEVEL, f"Answer cache: index version changed from {self._index_version} to {index_version}. Dropping {self._size} answers")
+            self._entries.clear()
+            self._size = 0
+            self._index_version = index_version
+
+    @staticmethod
+    def _unit(embedding):
+        vector = np.asarray(embedding, dtype = np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, question_embedding, retrieved_set, strict_rag, index_version):
+        query = self._unit(question_embedding)
+        with self._lock:
+            self._check_version(index_version)
+            key = (retrieved_set, strict_rag)
+            candidates = self._entries.get(key, [])
+            if candidates:
+                distances = 1.0 - np.stack([embedding for embedding, _ in candidates]) @ query
+                closest = int(np.argmin(distances))
+                if distances[closest] < self.max_distance:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return candidates[closest][1]
+            self.misses += 1
+            return None
+
+    def put(self, question_embedding, retrieved_set, strict_rag, index_version, answer):
+        with self._lock:
+            self._check_version(index_version)
+            key = (retrieved_set, strict_rag)
+            self._entries.setdefault(key, []).append([self._unit(question_embedding), answer])
+            self._entries.move_to_end(key)
+            self._size += 1
+            while self._size > self.max_entries:
+                _, evicted = self._entries.popitem(last = False)
+                self._size -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "size": self._size,
+                    "max_entries": self.max_entries}
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.log(ANALYSIS_LEVEL, f"Answer cache: {stats['hits']} hits, {stats['misses']} misses, hit rate {stats['hit_rate']:.1%}, {stats['size']}/{stats['max_entries']} entries")
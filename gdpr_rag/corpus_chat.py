@@ -0,0 +1,400 @@
+import contextvars
+import hashlib
+import json
+import logging
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import pandas as pd
+from openai.types.chat import ChatCompletion, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+
+from regulations_rag.corpus_chat import CorpusChat
+from regulations_rag.rerank import RerankAlgos
+
+from gdpr_rag.token_counts import token_counter
+from gdpr_rag.openai_scheduler import scheduler_lane
+from gdpr_rag.single_flight import single_flight
+
+logger = logging.getLogger(__name__)
+DEV_LEVEL = 15
+ANALYSIS_LEVEL = 25
+logging.addLevelName(DEV_LEVEL, 'DEV')
+logging.addLevelName(ANALYSIS_LEVEL, 'ANALYSIS')
+
+# Tokens the chat format adds to every message on top of its content
+tokens_per_message = 4
+
+
+def _retrieved_set(search_result):
+    '''
+    A hashable summary of everything similarity_search returned: the (section_reference, text) rows of each
+    DataFrame in the result. Two questions with the same summary give the model the same context.
+    '''
+    frames = search_result if isinstance(search_result, tuple) else (search_result,)
+    retrieved = []
+    for frame in frames:
+        if isinstance(frame, pd.DataFrame):
+            columns = [column for column in ["section_reference", "text"] if column in frame.columns]
+            retrieved.append(frozenset(frame[columns].itertuples(index = False, name = None)))
+    return tuple(retrieved)
+
+
+def _copy_frames(search_result):
+    if isinstance(search_result, tuple):
+        return tuple(_copy_frames(item) for item in search_result)
+    return search_result.copy() if isinstance(search_result, pd.DataFrame) else search_result
+
+
+class _SessionCompletions:
+    def __init__(self, completions, chat):
+        self._completions = completions
+        self._chat = chat
+
+    def __getattr__(self, name):
+        return getattr(self._completions, name)
+
+    def create(self, **kwargs):
+        # Only the first completion after similarity_search is the answer to the question that was searched for
+        is_answer, self._chat._answer_pending = self._chat._answer_pending, False
+        pending, self._chat._pending_answer = self._chat._pending_answer, None
+        if not is_answer or kwargs.get("stream") or kwargs.get("n", 1) != 1:
+            return self._completions.create(**kwargs)
+
+        cache = self._chat.answer_cache
+        if pending is not None:
+            lookup = pending + (self._chat.strict_rag, self._chat.index_version)
+            cached_content = cache.get(*lookup)
+            if cached_content is not None:
+                self._chat.last_answer_from_cache = True
+                message = ChatCompletionMessage(role = "assistant", content = cached_content)
+                return ChatCompletion(id = "answer_cache", object = "chat.completion", created = int(time.time()), model = kwargs.get("model", ""),
+                                      choices = [Choice(finish_reason = "stop", index = 0, message = message)])
+
+        # Sessions that send exactly the same request for the same standalone question at the same time share one call.
+        # The session that made it streams to every session that joined
+        stream_queue = self._chat._stream_queue
+        def generate(flight):
+            if stream_queue is None:
+                return self._completions.create(**kwargs)
+            flight.subscribe(stream_queue.put)
+            return self._create_streaming(kwargs, flight.publish)
+        join = (lambda flight: flight.subscribe(stream_queue.put)) if stream_queue is not None else None
+        request = hashlib.sha256(json.dumps(kwargs, sort_keys = True, default = str).encode("utf-8")).hexdigest()
+        key = ("answer", self._chat._pending_question, self._chat.strict_rag, self._chat.index_version, request)
+        response, is_leader = single_flight.do(key, generate, join)
+
+        choice = response.choices[0]
+        if pending is not None and is_leader and choice.finish_reason == "stop" and choice.message.content and not choice.message.tool_calls:
+            cache.put(*lookup, choice.message.content)
+        return response
+
+    def _create_streaming(self, kwargs, on_delta):
+        '''
+        Makes the call with stream = True, passes each piece of text to on_delta as it arrives and returns the
+        ChatCompletion the call would have returned without streaming
+        '''
+        stream = self._completions.create(**kwargs, stream = True, stream_options = {"include_usage": True})
+        parts = []
+        finish_reason = "stop"
+        response_id, created, model, usage = "", int(time.time()), kwargs.get("model", ""), None
+        for chunk in stream:
+            response_id, created, model = chunk.id, chunk.created, chunk.model
+            usage = chunk.usage or usage
+            if chunk.choices:
+                choice = chunk.choices[0]
+                if choice.delta.content:
+                    parts.append(choice.delta.content)
+                    on_delta(choice.delta.content)
+                finish_reason = choice.finish_reason or finish_reason
+        message = ChatCompletionMessage(role = "assistant", content = "".join(parts))
+        return ChatCompletion(id = response_id, object = "chat.completion", created = created, model = model, usage = usage,
+                              choices = [Choice(finish_reason = finish_reason, index = 0, message = message)])
+
+
+class _SessionChat:
+    def __init__(self, chat_client, chat):
+        self._chat_client = chat_client
+        self.completions = _SessionCompletions(chat_client.completions, chat)
+
+    def __getattr__(self, name):
+        return getattr(self._chat_client, name)
+
+
+class _SessionClient:
+    '''
+    Wraps the OpenAI client of one chat so that the answer generation call can be served from the answer cache
+    or streamed. Every other call is passed through unchanged.
+    '''
+    def __init__(self, client, chat):
+        self._client = client
+        self.chat = _SessionChat(client.chat, chat)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+# Shared by all sessions. Each question uses at most two workers, one per speculative retrieval stage
+_retrieval_executor = ThreadPoolExecutor(max_workers = 16, thread_name_prefix = "retrieval")
+
+
+def _same_arguments(a, b):
+    if len(a) != len(b):
+        return False
+    for x, y in zip(a, b):
+        if x is y:
+            continue
+        if isinstance(x, (list, np.ndarray)) or isinstance(y, (list, np.ndarray)):
+            if not np.array_equal(np.asarray(x), np.asarray(y)):
+                return False
+        elif x != y:
+            return False
+    return True
+
+
+class _ConcurrentRetrieval:
+    '''
+    Stands in for the corpus index of one chat. The definitions and workflow lookups only depend on the question
+    and its embedding, so whichever lookup CorpusChat calls first starts both on the retrieval executor with the
+    thresholds from embedding_parameters, and each later call picks up its result. A call whose arguments differ
+    from the ones that were started is run directly, so the results are always what the index would return.
+
+    The sections lookup is never started speculatively: its rerank can be a paid LLM call, so it only runs when it
+    is asked for. similarity_search always needs both definitions and sections, so GDPRCorpusChat asks for the two
+    together with definitions_and_sections, which runs them at the same time.
+
+    Every stage is timed; the timings of the last question are in stage_timings and the embedding it was looked up
+    with in question_embedding.
+    '''
+    def __init__(self, index, chat):
+        self._index = index
+        self._chat = chat
+        self._started = {}
+        self.stage_timings = {}
+        self.question_embedding = None
+        self._question_text = None
+
+    def __getattr__(self, name):
+        return getattr(self._index, name)
+
+    def _timed(self, stage, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self.stage_timings[stage] = time.perf_counter() - start
+
+    def _stage_arguments(self, user_content, user_content_embedding):
+        embedding_parameters = self._chat.embedding_parameters
+        threshold = getattr(embedding_parameters, "threshold", None)
+        threshold_definitions = getattr(embedding_parameters, "threshold_definitions", threshold)
+        arguments = {}
+        if threshold_definitions is not None:
+            arguments["definitions"] = (user_content, user_content_embedding, threshold_definitions)
+        if threshold is not None:
+            arguments["workflow"] = (user_content_embedding, threshold)
+        return arguments
+
+    def begin_question(self, user_content):
+        # The workflow lookup is not given the question text, so it is kept here for when the workflow is asked for first
+        self._started = {}
+        self.stage_timings = {}
+        self.question_embedding = None
+        self._question_text = user_content
+
+    def _start(self, user_content, user_content_embedding):
+        question = (user_content, user_content_embedding)
+        if "question" in self._started and _same_arguments(self._started["question"], question):
+            return
+        self.stage_timings = {}
+        self.question_embedding = user_content_embedding
+        methods = {"definitions": self._index.get_relevant_definitions,
+                   "workflow": self._index.get_relevant_workflow}
+        self._started = {"question": question}
+        for stage, arguments in self._stage_arguments(user_content, user_content_embedding).items():
+            # copy_context so the lookups (and the LLM rerank) are scheduled in this session's lane
+            self._started[stage] = (arguments, _retrieval_executor.submit(contextvars.copy_context().run, self._timed, stage, methods[stage], *arguments))
+
+    def _run(self, stage, method, arguments):
+        if stage in self._started:
+            started_arguments, future = self._started.pop(stage)
+            if _same_arguments(started_arguments, arguments):
+                return future.result()
+            logger.log(DEV_LEVEL, f"The {stage} lookup was called with other arguments than the ones it was started with. Running it again")
+        return self._timed(stage, method, *arguments)
+
+    def get_relevant_definitions(self, user_content, user_content_embedding, threshold):
+        self._start(user_content, user_content_embedding)
+        return self._run("definitions", self._index.get_relevant_definitions, (user_content, user_content_embedding, threshold))
+
+    def get_relevant_sections(self, user_content, user_content_embedding, threshold, rerank_algo = RerankAlgos.NONE):
+        self._start(user_content, user_content_embedding)
+        return self._timed("sections", self._index.get_relevant_sections, user_content, user_content_embedding, threshold, rerank_algo)
+
+    def definitions_and_sections(self, user_content, user_content_embedding):
+        '''
+        Returns (relevant definitions, relevant sections) with the thresholds from embedding_parameters and the chat's
+        rerank algorithm. The sections lookup runs on the retrieval executor while the definitions lookup is picked up
+        '''
+        embedding_parameters = self._chat.embedding_parameters
+        threshold_definitions = getattr(embedding_parameters, "threshold_definitions", embedding_parameters.threshold)
+        self._start(user_content, user_content_embedding)
+        sections = _retrieval_executor.submit(contextvars.copy_context().run, self._timed, "sections", self._index.get_relevant_sections,
+                                              user_content, user_content_embedding, embedding_parameters.threshold, self._chat.rerank_algo)
+        definitions = self._run("definitions", self._index.get_relevant_definitions, (user_content, user_content_embedding, threshold_definitions))
+        return definitions, sections.result()
+
+    def get_relevant_workflow(self, user_content_embedding, threshold):
+        if "question" in self._started:
+            user_content = self._started["question"][0]
+        else:
+            user_content = self._question_text
+        if user_content is not None:
+            self._start(user_content, user_content_embedding)
+        return self._run("workflow", self._index.get_relevant_workflow, (user_content_embedding, threshold))
+
+    def finish_question(self):
+        # Lookups that CorpusChat did not use this time are left to finish on their own
+        self._started = {}
+        self._question_text = None
+        return self.stage_timings
+
+
+class GDPRCorpusChat(CorpusChat):
+    '''
+    CorpusChat that can stream the answer as it is generated (user_provides_input_streaming) and serve the answer to
+    a near-duplicate standalone question from a process-wide AnswerCache. The retrieval stages of each question run
+    concurrently, see _ConcurrentRetrieval.
+
+    The model output is cached rather than the response object, and it is served in place of the generation call.
+    CorpusChat then builds the AnswerWithRAGResponse, references included, from the same retrieved sections exactly
+    as it would have for a fresh answer. messages_intermediate[-1]["from_cache"] is True when that happened.
+    Only use an answer cache with temperature = 0.
+    '''
+    def __init__(self, *args, answer_cache = None, **kwargs):
+        self.answer_cache = answer_cache
+        self._pending_answer = None
+        self.last_answer_from_cache = False
+        self._answer_pending = False
+        self._stream_queue = None
+        self._pending_question = None
+        # Every OpenAI call made for this chat is queued in its own lane of the process-wide scheduler
+        self._scheduler_lane = uuid.uuid4().hex
+        chat_parameters = kwargs["chat_parameters"] if "chat_parameters" in kwargs else args[1]
+        chat_parameters.openai_client = _SessionClient(chat_parameters.openai_client, self)
+        super().__init__(*args, **kwargs)
+        self.index = _ConcurrentRetrieval(self.index, self)
+
+    @property
+    def index_version(self):
+        return getattr(self.index, "index_version", None)
+
+    def _embed(self, user_content):
+        response = self.chat_parameters.openai_client.embeddings.create(input = user_content,
+                                                                         model = self.embedding_parameters.model,
+                                                                         dimensions = self.embedding_parameters.dimensions)
+        return response.data[0].embedding
+
+    def _timed_similarity_search(self, user_content):
+        '''
+        What CorpusChat.similarity_search does, (relevant definitions, relevant sections), but with the two lookups run
+        at the same time. Returns that and the embedding of user_content that the index was searched with
+        '''
+        start = time.perf_counter()
+        self.index.begin_question(user_content)
+        try:
+            user_content_embedding = self._embed(user_content)
+            return self.index.definitions_and_sections(user_content, user_content_embedding), user_content_embedding
+        finally:
+            stage_timings = self.index.finish_question()
+            total = time.perf_counter() - start
+            stages = ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in stage_timings.items())
+            logger.log(DEV_LEVEL, f"similarity_search took {total:.3f}s. Retrieval stages (run concurrently): {stages}")
+
+    def similarity_search(self, user_content):
+        # Sessions searching for the same standalone question at the same time share one search (embedding and rerank included)
+        key = ("search", user_content, self.strict_rag, self.index_version)
+        (search_result, question_embedding), is_leader = single_flight.do(key, lambda flight: self._timed_similarity_search(user_content))
+        if not is_leader:
+            # The leader's DataFrames are handed on to its own CorpusChat, so work on copies
+            search_result = _copy_frames(search_result)
+        self._pending_question = user_content
+        self._answer_pending = True
+        if self.answer_cache is not None:
+            retrieved_set = _retrieved_set(search_result)
+            # Nothing retrieved means the answer is not grounded in the corpus, so it is not worth caching
+            if any(retrieved_set) and question_embedding is not None:
+                self._pending_answer = (question_embedding, retrieved_set)
+        return search_result
+
+    def user_provides_input(self, user_content):
+        self.last_answer_from_cache = False
+        self._answer_pending = False
+        self._pending_answer = None
+        lane = scheduler_lane.set(self._scheduler_lane)
+        try:
+            result = super().user_provides_input(user_content)
+        finally:
+            scheduler_lane.reset(lane)
+            self._answer_pending = False
+            self._pending_answer = None
+            self._pending_question = None
+        if self.last_answer_from_cache and self.messages_intermediate:
+            self.messages_intermediate[-1]["from_cache"] = True
+            logger.log(ANALYSIS_LEVEL, "Answer served from the answer cache")
+        return result
+
+    def _count_message_tokens(self, message, memoise = True):
+        # Memoised by default, so a message in the history is only encoded the first time it is seen
+        return tokens_per_message + token_counter.count(message.get("content") or "", memoise = memoise)
+
+    def _truncate_message_list(self, system_message, message_list, token_limit = 2000):
+        '''
+        Returns system_message followed by the most recent messages in message_list that fit in token_limit
+        (the most recent one is always kept). With the counts memoised this is one cumulative sum and a search over it
+        '''
+        system_messages = system_message if isinstance(system_message, list) else [system_message]
+        # The system message holds the sections retrieved for this question, so it is almost never seen again
+        available = token_limit - sum(self._count_message_tokens(message, memoise = False) for message in system_messages)
+        counts_from_latest = np.cumsum([self._count_message_tokens(message) for message in reversed(message_list)])
+        n_kept = max(1, int(np.searchsorted(counts_from_latest, available, side = "right"))) if message_list else 0
+        return system_messages + message_list[len(message_list) - n_kept:]
+
+    def user_provides_input_streaming(self, user_content, prepare_thread = None):
+        '''
+        Generator version of user_provides_input. The pipeline runs on a worker thread and the text of the answer is
+        yielded as the model generates it. Once the generator is exhausted messages_intermediate[-1] holds the full
+        response, exactly as after user_provides_input. Nothing is yielded when the answer comes from the cache or
+        the pipeline does not reach generation.
+
+        :param prepare_thread: Called with the worker thread before it starts, e.g. to attach the Streamlit script
+                               context so the progress callback can update the page
+        '''
+        deltas = queue.Queue()
+        errors = []
+        def run():
+            try:
+                self.user_provides_input(user_content)
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                deltas.put(None)
+
+        self._stream_queue = deltas
+        worker = threading.Thread(target = run, name = "corpus_chat_stream", daemon = True)
+        if prepare_thread is not None:
+            prepare_thread(worker)
+        worker.start()
+        try:
+            while (delta := deltas.get()) is not None:
+                yield delta
+            worker.join()
+        finally:
+            self._stream_queue = None
+        if errors:
+            raise errors[0]
@@ -1,10 +1,19 @@
+import copy
 import logging
-import os
+import threading
+import numpy as np
 import pandas as pd
 
-from regulations_rag.file_tools import load_parquet_data
 from regulations_rag.corpus_index import DataFrameCorpusIndex
+from regulations_rag.rerank import RerankAlgos
 from gdpr_rag.gdpr_corpus import GDPRCorpus
+from gdpr_rag.index_artifact import default_index_folder, default_artifact_folder, read_manifest, \
+                                    load_index_artifact, load_index_folder, index_folder_fingerprint, add_definition_text
+from gdpr_rag.shared_index import default_shared_folder, attach_shared_index, publish_shared_index
+from gdpr_rag.vector_index import create_vector_index, cosine_distances
+from gdpr_rag.lexical_rerank import BM25Rerank
+from gdpr_rag.sparse_index import load_sparse_index, build_sparse_index, reciprocal_rank_fusion, default_rrf_k
+from gdpr_rag.token_counts import token_counter, rendered_section_text
 
 # Create a logger for this module
 logger = logging.getLogger(__name__)
@@ -13,34 +22,184 @@ logging.addLevelName(DEV_LEVEL, 'DEV')
 
 required_columns_workflow = ["workflow", "text", "embedding"]
 
+# The vector index only shortlists rows. The base class still applies the threshold to its own distance calculation,
+# so shortlist with a little slack to allow for float32 rounding
+shortlist_threshold_slack = 1e-4
+
+default_hybrid_params = {
+    "n_sparse": 20,          # rows taken from the sparse ranking
+    "max_candidates": 15,    # rows kept after fusion, i.e. sent on to the rerank
+    "rrf_k": default_rrf_k,
+}
+
 class GDPRCorpusIndex(DataFrameCorpusIndex):
-    def __init__(self, key):
-        corpus = GDPRCorpus("./gdpr_rag/documents/")
-        index_folder = "./inputs/index/"
-        index_df = pd.DataFrame()
-        for filename in os.listdir(index_folder):
-            if filename.endswith(".parquet"):  
-                filepath = os.path.join(index_folder, filename)
-                df = load_parquet_data(filepath, key)
-                index_df = pd.concat([index_df, df], ignore_index = True)
+    def __init__(self, key, index_folder = default_index_folder, artifact_folder = default_artifact_folder, load_mode = "thread", lazy_corpus = False, warm_up_corpus = False,
+                 shared_memory = False, shared_folder = default_shared_folder, vector_backend = "exact", vector_backend_params = None,
+                 hybrid_search = False, hybrid_params = None):
+        '''
+        :param shared_memory: Attach to (or publish) a host-wide, memory-mapped copy of the definitions and index
+                              so several app processes on one host do not each hold their own copy. See gdpr_rag/shared_index.py
+        :param vector_backend: "exact", "ivf", "int8" or "truncated". See gdpr_rag/vector_index.py. vector_backend_params are passed to its constructor
+                               e.g. {"n_probe": 8} for "ivf"
+        :param hybrid_search: Fuse the dense results with a sparse (BM25) ranking of the sections by reciprocal-rank fusion.
+                              hybrid_params overrides default_hybrid_params
+        '''
+        corpus = GDPRCorpus("./gdpr_rag/documents/", lazy = lazy_corpus, warm_up = warm_up_corpus)
 
         user_type = "a Controller"
         corpus_description = "the General Data Protection Regulation (GDPR)"
 
-        definitions = index_df[index_df['source'] == 'definitions'].copy(deep=True)
-        # I now need to add the actual definitions in using the get_test method
-        doc = corpus.get_document("GDPR")
-        definitions['definition'] = definitions['section_reference'].apply(lambda x: doc.get_text(section_reference = x, add_markdown_decorators = False, add_headings = False))
-        # ... except the get_text method adds some stuff before the defn so I strip it out
-        definitions['definition'] = definitions['definition'].str.replace(r'^\s*\d+\.\s*', '', regex=True)
+        manifest = read_manifest(artifact_folder, index_folder)
+        self.index_version = manifest["version"] if manifest is not None else index_folder_fingerprint(index_folder)
+
+        frames = attach_shared_index(self.index_version, key, shared_folder) if shared_memory else None
+        if frames is None:
+            frames = self._load_frames(key, corpus, index_folder, artifact_folder, load_mode, manifest)
+            if shared_memory:
+                publish_shared_index(frames, self.index_version, key, shared_folder)
+                # swap the private copy for the shared one
+                frames = attach_shared_index(self.index_version, key, shared_folder) or frames
+
+        frames = self._split_token_counts(frames)
 
-        index = index_df[index_df['source'] != 'definitions'].copy(deep=True)
         workflow = pd.DataFrame([], columns = required_columns_workflow)
 
-        super().__init__(user_type, corpus_description, corpus, definitions, index, workflow)
+        super().__init__(user_type, corpus_description, corpus, frames["definitions"], frames["index"], workflow)
+
+        # Built once here so a question is one matrix product rather than a scan over the embedding column
+        vector_backend_params = vector_backend_params or {}
+        # The rows are passed as they are (views into the memory-mapped artifact or shared index when there is one) so
+        # "exact" and "int8" search them in place rather than each process holding its own float32 copy
+        self.definition_vectors = create_vector_index(list(frames["definitions"]["embedding"]), vector_backend, **vector_backend_params)
+        self.section_vectors = create_vector_index(list(frames["index"]["embedding"]), vector_backend, **vector_backend_params)
+        self._sparse_artifact_folder = artifact_folder if manifest is not None else None
+        self._section_bm25 = None
+        self._section_bm25_lock = threading.Lock()
+        self.hybrid_search = hybrid_search
+        self.hybrid_params = {**default_hybrid_params, **(hybrid_params or {})}
+        if hybrid_search:
+            # Every question needs it, so do not leave it to the first one
+            self.section_bm25
+
+    @property
+    def section_bm25(self):
+        '''
+        Sparse index over the sections, used for hybrid search and by BM25Rerank. Loaded from the artifact the first
+        time it is needed, or built if the artifact does not have one for this index version. Building it renders every
+        section, so it loads the whole corpus
+        '''
+        if self._section_bm25 is None:
+            with self._section_bm25_lock:
+                if self._section_bm25 is None:
+                    section_bm25 = load_sparse_index(self._sparse_artifact_folder, self.index_version) if self._sparse_artifact_folder is not None else None
+                    self._section_bm25 = section_bm25 if section_bm25 is not None else build_sparse_index(self.index, self.corpus)
+        return self._section_bm25
+
+    def _load_frames(self, key, corpus, index_folder, artifact_folder, load_mode, manifest):
+        # Prefer the consolidated artifact (see gdpr_rag/index_artifact.py) and only decrypt the individual files if it
+        # is missing or was built from other index files
+        artifact = load_index_artifact(key, artifact_folder, index_folder, manifest) if manifest is not None else None
+        if artifact is not None:
+            index_df, manifest = artifact
+            logger.log(DEV_LEVEL, f"Loaded index artifact version {manifest['version']} from {artifact_folder}")
+        else:
+            logger.log(DEV_LEVEL, f"No index artifact in {artifact_folder}. Loading the individual files in {index_folder}")
+            index_df = load_index_folder(index_folder, key, mode = load_mode)
+
+        # The artifact already contains the text of each definition. Otherwise build it in one pass over Article 4
+        if 'definition' not in index_df.columns:
+            index_df = add_definition_text(index_df, corpus.get_document("GDPR"))
+
+        definitions = index_df[index_df['source'] == 'definitions'].copy(deep=True)
+        index = index_df[index_df['source'] != 'definitions'].drop(columns = ['definition'])
+        return {"definitions": definitions, "index": index}
+
+    def _split_token_counts(self, frames):
+        '''
+        Takes the token counts that the artifact stores with each row out of the frames and into
+        self.section_token_count_lookup: the tokens in each rendered document section, keyed on (document, section_reference).
+        They are estimates (see token_counts.rendered_section_text) that the BM25 rerank plans with, until
+        cap_rag_section_token_length has counted the actual prompt text. Without an artifact the section counts are
+        made as each section is first needed, see rendered_section_token_counts.
+        '''
+        index = frames["index"]
+        self.section_token_count_lookup = {}
+        if "section_token_count" in index.columns and "document" in index.columns:
+            self.section_token_count_lookup = dict(zip(zip(index["document"], index["section_reference"]), index["section_token_count"].astype(int)))
+        return {name: df.drop(columns = ["section_token_count"], errors = "ignore") for name, df in frames.items()}
+
+    def rendered_section_token_counts(self, positions):
+        '''
+        The tokens in the rendered document section that each of the index rows at positions points to, i.e. what it
+        adds to the prompt. Sections that are not in section_token_count_lookup yet are rendered, counted and added
+        '''
+        if "document" not in self.index.columns:
+            return np.array([token_counter.count(text) for text in self.index["text"].iloc[positions]], dtype = np.int64)
+        counts = []
+        for key in self.index[["document", "section_reference"]].iloc[positions].itertuples(index = False, name = None):
+            count = self.section_token_count_lookup.get(key)
+            if count is None:
+                count = token_counter.count(rendered_section_text(self.corpus, *key))
+                self.section_token_count_lookup[key] = count
+            counts.append(count)
+        return np.array(counts, dtype = np.int64)
+
+    def _with_frames(self, **frames):
+        '''
+        A shallow copy of this index with some of its DataFrames replaced, so the base class methods can run on a
+        shortlist without changing the index that all the sessions share
+        '''
+        restricted = copy.copy(self)
+        for name, df in frames.items():
+            setattr(restricted, name, df)
+        return restricted
+
+    def get_relevant_definitions(self, user_content, user_content_embedding, threshold):
+        positions, _ = self.definition_vectors.search(user_content_embedding, threshold + shortlist_threshold_slack)
+        restricted = self._with_frames(definitions = self.definitions.iloc[positions])
+        return super(GDPRCorpusIndex, restricted).get_relevant_definitions(user_content, user_content_embedding, threshold)
+
+    def _hybrid_candidates(self, user_content, user_content_embedding, positions):
+        '''
+        Fuses the dense ranking (positions, closest first) with the best sparse matches for user_content and keeps
+        the best max_candidates rows. Returns (positions, cosine distances)
+        '''
+        scores = self.section_bm25.scores(user_content)
+        n_sparse = min(self.hybrid_params["n_sparse"], int((scores > 0).sum()))
+        sparse_ranking = np.argpartition(-scores, n_sparse - 1)[:n_sparse] if n_sparse > 0 else np.zeros(0, dtype = np.int64)
+        sparse_ranking = sparse_ranking[np.argsort(-scores[sparse_ranking], kind = "stable")]
+        fused, _ = reciprocal_rank_fusion([positions, sparse_ranking], k = self.hybrid_params["rrf_k"])
+        fused = fused[:self.hybrid_params["max_candidates"]]
+        return fused, cosine_distances([self.index["embedding"].iloc[position] for position in fused], user_content_embedding)
+
+    def get_relevant_sections(self, user_content, user_content_embedding, threshold, rerank_algo = RerankAlgos.NONE):
+        positions, distances = self.section_vectors.search(user_content_embedding, threshold + shortlist_threshold_slack)
+        if self.hybrid_search:
+            positions, distances = self._hybrid_candidates(user_content, user_content_embedding, positions)
+            # Sparse matches can be further away than the threshold. The base class filters on distance again, so
+            # widen its threshold just enough to keep every fused candidate
+            if len(distances):
+                threshold = max(threshold, float(distances.max()) + shortlist_threshold_slack)
+        if isinstance(rerank_algo, BM25Rerank):
+            positions = rerank_algo.select(user_content, positions, distances, self.section_bm25, self.rendered_section_token_counts)
+            rerank_algo = RerankAlgos.NONE
+        restricted = self._with_frames(index = self.index.iloc[positions])
+        return super(GDPRCorpusIndex, restricted).get_relevant_sections(user_content, user_content_embedding, threshold, rerank_algo)
+
+    def cap_rag_section_token_length(self, relevant_sections, capped_number_of_tokens):
+        '''
+        Keeps the sections, in order, until their total number of tokens would exceed capped_number_of_tokens.
+        The text that goes into the prompt is counted with the process-wide token_counter, so each distinct section is
+        only encoded once. The counts of rendered sections are also kept in section_token_count_lookup, in place of
+        the artifact's, for the BM25 rerank
+        '''
+        if len(relevant_sections) == 0:
+            return relevant_sections
+        text_column = "regulation_text" if "regulation_text" in relevant_sections.columns else "text"
+        counts = [token_counter.count(text) for text in relevant_sections[text_column]]
+        if text_column == "regulation_text" and "document" in relevant_sections.columns:
+            self.section_token_count_lookup.update(zip(zip(relevant_sections["document"], relevant_sections["section_reference"]), counts))
+        return relevant_sections[np.cumsum(counts) <= capped_number_of_tokens]
 
-#     def get_relevant_definitions(self, user_content, user_content_embedding, threshold):
-#     def cap_rag_section_token_length(self, relevant_sections, capped_number_of_tokens):
-#     def get_relevant_sections(self, user_content, user_content_embedding, threshold, rerank_algo = RerankAlgos.NONE):
 #     def get_relevant_workflow(self, user_content_embedding, threshold):
 
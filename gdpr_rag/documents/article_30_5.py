@@ -1,6 +1,7 @@
 import pandas as pd
 from regulations_rag.document import Document
 from regulations_rag.regulation_table_of_content import StandardTableOfContent
+from gdpr_rag.section_cache import cached_section
 from io import StringIO
 
 
@@ -39,12 +40,14 @@ class Article_30_5(Document):
                 return False
         return True
 
+    @cached_section
     def get_text(self, section_reference, add_markdown_decorators = True, add_headings = True, section_only = True):
         if section_reference == "" or section_reference == "all":
             return self.document_as_df.iloc[0]['text']
         else:
             return ""
 
+    @cached_section
     def get_heading(self, section_reference, add_markdown_decorators = False):
         if section_reference == "" or section_reference == "all":
             return "Entire document"
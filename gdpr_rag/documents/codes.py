@@ -4,6 +4,7 @@ from regulations_rag.document import Document
 from regulations_rag.reference_checker import ReferenceChecker
 from regulations_rag.reference_checker import MultiReferenceChecker
 from regulations_rag.regulation_table_of_content import StandardTableOfContent
+from gdpr_rag.section_cache import cached_section
 
 
 
@@ -33,10 +34,12 @@ class Codes(Document):
                 return False
         return True
 
+    @cached_section
     def get_text(self, section_reference, add_markdown_decorators = True, add_headings = True, section_only = True):
         text, footnotes = super().get_text_and_footnotes(section_reference, add_markdown_decorators, add_headings, section_only)
         return super()._format_text_and_footnotes(text, footnotes)
 
+    @cached_section
     def get_heading(self, section_reference, add_markdown_decorators = False):
         return super().get_heading(section_reference, add_markdown_decorators)
 
@@ -3,6 +3,7 @@ import re
 from regulations_rag.document import Document
 from regulations_rag.reference_checker import ReferenceChecker
 from regulations_rag.regulation_table_of_content import StandardTableOfContent
+from gdpr_rag.section_cache import cached_section
 
 
 
@@ -26,6 +27,10 @@ class GDPR(Document):
 
         self.toc_reference_checker = self.GDPRToCReferenceChecker()
         self.toc = self.get_toc()
+        self._build_reference_index()
+        # Every row rendered once for each value of add_markdown_decorators so get_text only has to join them
+        self._rendered_lines = {False: self._render_lines(space = " ", line_end = "\n"),
+                                True: self._render_lines(space = '&nbsp;', line_end = "\n\n")}
 
 
     def check_columns(self):
@@ -39,6 +44,48 @@ class GDPR(Document):
         return True
 
 
+    # Splits "5(1)(a)" into ["5", "(1)", "(a)"]
+    _reference_parts_pattern = re.compile(r'\d+|\([^)]*\)')
+
+    def _get_reference_and_ancestors(self, section_reference):
+        '''
+        "5(1)(a)" -> ["5", "5(1)", "5(1)(a)"]
+        '''
+        parts = self._reference_parts_pattern.findall(section_reference)
+        return ["".join(parts[:i + 1]) for i in range(len(parts))]
+
+    def _build_reference_index(self):
+        '''
+        Maps every reference to the positions of its own rows and to the positions of the rows in its subtree
+        (the reference and all its children) so get_text and get_heading do not have to scan the whole DataFrame
+        '''
+        self._rows_by_reference = {}
+        self._subtree_rows_by_reference = {}
+        for position, section_reference in enumerate(self.document_as_df["section_reference"]):
+            self._rows_by_reference.setdefault(section_reference, []).append(position)
+            for reference in self._get_reference_and_ancestors(section_reference):
+                self._subtree_rows_by_reference.setdefault(reference, []).append(position)
+
+    def _get_row_positions(self, section_reference):
+        '''
+        Positions, in document order, of the rows for section_reference, its children and its parents
+        '''
+        section_reference = self.reference_checker.remove_prefix(section_reference)
+        positions = set(self._subtree_rows_by_reference.get(section_reference, []))
+        for parent_reference in self._get_reference_and_ancestors(section_reference)[:-1]:
+            positions.update(self._rows_by_reference.get(parent_reference, [])) # only the lines for the parent
+        return sorted(positions)
+
+    def _render_lines(self, space, line_end):
+        df = self.document_as_df
+        lines = df["content"] + line_end
+        major_lines = 1 * 4 * space + df["major_reference"] + ". " + lines
+        minor_lines = 2 * 4 * space + "(" + df["minor_reference"] + ") " + lines
+        lines = lines.where(df["major_reference"] == "", major_lines)
+        lines = lines.where(df["minor_reference"] == "", minor_lines)
+        return lines.to_list()
+
+    @cached_section
     def get_text(self, section_reference, add_markdown_decorators = True, add_headings = True, section_only = False):       
         # section_only = True does not make a lot of sense for this document
         footnote_pattern = ''
@@ -48,108 +95,92 @@ class GDPR(Document):
                 gdpr_reference = node.full_node_name.split('.', 1)[1]
                 return self.get_text(gdpr_reference, add_markdown_decorators, add_headings, section_only)
             else:
-                all_article_text = ""
+                all_article_text = []
                 for child in node.children:
                     child_node_gdpr_reference = child.full_node_name.split('.', 1)[1]
-                    all_article_text = all_article_text + self.get_text(child_node_gdpr_reference, add_markdown_decorators, add_headings, section_only) + "\n\n"
-                return all_article_text
+                    all_article_text.append(self.get_text(child_node_gdpr_reference, add_markdown_decorators, add_headings, section_only) + "\n\n")
+                return "".join(all_article_text)
 
         if not self.reference_checker.is_valid(section_reference):
             return ""
 
         if section_reference == "":
-            subframe = self.document_as_df
+            positions = range(len(self.document_as_df))
         else:
-            pattern = r'^\d{1,2}$' # there is a special case here were if I ask for "2" for example, the "startswith()" query will also include 21, 22 etc
-            if re.match(pattern, section_reference):
-                tmp1 = self.document_as_df[self.document_as_df["section_reference"].str.startswith(section_reference + "(")] # use startswith to get children as well
-                tmp2 = self.document_as_df[self.document_as_df["section_reference"] == section_reference] 
-                subframe = pd.concat([tmp1, tmp2]).sort_index()
-            else:
-                subframe = self.document_as_df[self.document_as_df["section_reference"].str.startswith(section_reference)] # use startswith to get children as well
-            parent_reference = self.reference_checker.get_parent_reference(section_reference)
-            while parent_reference:
-                parent_df = self.document_as_df[self.document_as_df["section_reference"] == (parent_reference)] # use equality to get only the lines for the parent
-                subframe = pd.concat([subframe, parent_df]).sort_index()
-                parent_reference = self.reference_checker.get_parent_reference(parent_reference)
-
-            if len(subframe) == 0:
-                return ""
+            positions = self._get_row_positions(section_reference)
+        if len(positions) == 0:
+            return ""
 
-        space = " "
         line_end = "\n"
         formatted_regulation = ""
         if add_markdown_decorators:
-            space = '&nbsp;'
             line_end = "\n\n"
             formatted_regulation = "# "
 
         if add_headings:
-            formatted_regulation = formatted_regulation + f"{subframe.iloc[0]['article_number']} {subframe.iloc[0]['article_heading']}{line_end}"  
-        
-        for index, row in subframe.iterrows():
-            line = row["content"] + line_end
-            if row["minor_reference"]:
-                line = 2 * 4 * space + f"({row['minor_reference']}) " + line
-            elif row["major_reference"]:
-                line = 1 * 4 * space + f"{row['major_reference']}. " + line
-            else:
-                line = line
-
+            first_row = self.document_as_df.iloc[positions[0]]
+            formatted_regulation = formatted_regulation + f"{first_row['article_number']} {first_row['article_heading']}{line_end}"  
 
-            formatted_regulation = formatted_regulation + line
-
-        return formatted_regulation
+        rendered_lines = self._rendered_lines[bool(add_markdown_decorators)]
+        return formatted_regulation + "".join([rendered_lines[position] for position in positions])
 
 
     # Note: This method will not work correctly if empty values in the dataframe are NaN as is the case when loading
-    #       a dataframe form a file without the 'na_filter=False' option. You should ensure that the dataframe does 
+    #       a dataframe form a file without the 'na_filter=False' option. You should ensure that the dataframe does
     #       not have any NaN value for the text fields. Try running self.document_as_df.isna().any().any() as a test before you get here
+    @cached_section
     def get_heading(self, section_reference, add_markdown_decorators = False):
-        ## NOTE add_markdown_decorators not implemented 
+        ## NOTE add_markdown_decorators not implemented
         if not self.reference_checker.is_valid(section_reference):
             return ""
 
-        pattern = r'^\d{1,2}$' # there is a special case here were if I ask for "2" for example, the "startswith()" query will also include 21, 22 etc
-        if re.match(pattern, section_reference):
-            tmp1 = self.document_as_df[self.document_as_df["section_reference"].str.startswith(section_reference + "(")] # use startswith to get children as well
-            tmp2 = self.document_as_df[self.document_as_df["section_reference"] == section_reference] 
-            subframe = pd.concat([tmp1, tmp2], ignore_index=True).sort_index()
+        if section_reference == "":
+            positions = range(len(self.document_as_df)) # the whole document, as in get_text
         else:
-            subframe = self.document_as_df[self.document_as_df["section_reference"].str.startswith(section_reference)] # use startswith to get children as well
-        parent_reference = self.reference_checker.get_parent_reference(section_reference)
-        while parent_reference:
-            parent_df = self.document_as_df[self.document_as_df["section_reference"] == (parent_reference)] # use equality to get only the lines for the parent
-            subframe = pd.concat([subframe, parent_df], ignore_index=True).sort_index()
-            parent_reference = self.reference_checker.get_parent_reference(parent_reference)
-
-        if len(subframe) == 0:
+            positions = self._get_row_positions(section_reference)
+        if len(positions) == 0:
             return ""
+        first_row = self.document_as_df.iloc[positions[0]]
 
         formatted_regulation = ""
-        formatted_regulation = f"Chapter {subframe.iloc[0]['chapter_number']} {subframe.iloc[0]['chapter_heading']}."  
-        if subframe.iloc[0]['section_number']:
-            formatted_regulation = formatted_regulation + f" Section {subframe.iloc[0]['section_number']} {subframe.iloc[0]['section_heading']}."  
+        formatted_regulation = f"Chapter {first_row['chapter_number']} {first_row['chapter_heading']}."
+        if first_row['section_number']:
+            formatted_regulation = formatted_regulation + f" Section {first_row['section_number']} {first_row['section_heading']}."
 
-        formatted_regulation = formatted_regulation + f" Article {subframe.iloc[0]['article_number']} {subframe.iloc[0]['article_heading']}."  
+        formatted_regulation = formatted_regulation + f" Article {first_row['article_number']} {first_row['article_heading']}."
 
         return formatted_regulation
 
+    def get_definition_texts(self):
+        '''
+        Returns a Series, indexed by section_reference (e.g. "4(1)"), with the text of every definition in Article 4.
+
+        This is what get_text(reference, add_markdown_decorators = False, add_headings = False) returns for a definition,
+        without the leading "1. ", but built in one pass over the Article 4 rows instead of one get_text call per definition.
+        '''
+        article = self.document_as_df[(self.document_as_df["article_number"] == 4) & (self.document_as_df["major_reference"] != "")]
+        lines = article["content"] + "\n"
+        has_minor = article["minor_reference"] != ""
+        lines = lines.where(~has_minor, 2 * 4 * " " + "(" + article["minor_reference"] + ") " + lines)
+        definition_reference = "4(" + article["major_reference"] + ")"
+        return lines.groupby(definition_reference, sort = False).agg("".join)
+
     def get_toc(self):
         # create the dataframe using chapters and articles
+        # only the rows where the chapter or the article changes add nodes to the tree
+        df = self.document_as_df
+        chapter_changed = df["chapter_number"] != df["chapter_number"].shift()
+        article_changed = df["article_number"] != df["article_number"].shift()
+        changes = df[chapter_changed | article_changed]
+
         gdpr_data_for_tree = []
-        chapter_number = ""
-        article_number = 0
-
-        for index, row in self.document_as_df.iterrows():
-            if row["chapter_number"] != chapter_number:
-                chapter_number = row["chapter_number"]
-                section_number = ""
-                gdpr_data_for_tree.append([row["chapter_number"], True, row["chapter_heading"]])
-
-            if row["article_number"] != article_number:
-                article_number = row["article_number"]
-                gdpr_data_for_tree.append([f'{chapter_number}.{row["article_number"]}', True, row["article_heading"]])
+        for new_chapter, new_article, chapter_number, chapter_heading, article_number, article_heading in zip(
+                chapter_changed[changes.index], article_changed[changes.index],
+                changes["chapter_number"], changes["chapter_heading"], changes["article_number"], changes["article_heading"]):
+            if new_chapter:
+                gdpr_data_for_tree.append([chapter_number, True, chapter_heading])
+            if new_article:
+                gdpr_data_for_tree.append([f'{chapter_number}.{article_number}', True, article_heading])
 
         gdpr_df_for_tree = pd.DataFrame(gdpr_data_for_tree, columns = ["section_reference", "heading", "text"])
 
@@ -0,0 +1,138 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from openai import NOT_GIVEN
+from openai.types import CreateEmbeddingResponse, Embedding
+from openai.types.create_embedding_response import Usage
+
+logger = logging.getLogger(__name__)
+ANALYSIS_LEVEL = 25
+logging.addLevelName(ANALYSIS_LEVEL, 'ANALYSIS')
+
+default_embedding_cache_path = "./cache/embedding_cache.sqlite"
+default_max_entries = 50000
+
+_whitespace_pattern = re.compile(r'\s+')
+
+
+def normalise_question(text):
+    '''
+    The part of the question text that is used as the cache key: case folded with runs of whitespace collapsed,
+    so "Can employers monitor workers' emails?" and "can employers  monitor workers' emails? " share an entry
+    '''
+    return _whitespace_pattern.sub(" ", text).strip().casefold()
+
+
+class EmbeddingCache:
+    '''
+    Disk-backed cache of question embeddings keyed on (normalised text, model, dimensions). It is a single SQLite
+    file so it survives restarts and can be shared by every app process on the host. When it grows beyond
+    max_entries the least recently used entries are removed.
+    '''
+    def __init__(self, path = default_embedding_cache_path, max_entries = default_max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok = True)
+        # One connection for the process, used under self._lock. WAL lets other processes read while one writes
+        self._connection = sqlite3.connect(path, timeout = 10, check_same_thread = False, isolation_level = None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+                                        text TEXT NOT NULL,
+                                        model TEXT NOT NULL,
+                                        dimensions INTEGER NOT NULL,
+                                        embedding BLOB NOT NULL,
+                                        last_used REAL NOT NULL,
+                                        PRIMARY KEY (text, model, dimensions))""")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+
+    def get(self, text, model, dimensions):
+        key = (normalise_question(text), model, dimensions or 0)
+        with self._lock:
+            row = self._connection.execute("SELECT embedding FROM embeddings WHERE text = ? AND model = ? AND dimensions = ?", key).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._connection.execute("UPDATE embeddings SET last_used = ? WHERE text = ? AND model = ? AND dimensions = ?", (time.time(),) + key)
+        return np.frombuffer(row[0], dtype = np.float32).tolist()
+
+    def put(self, text, model, dimensions, embedding):
+        key = (normalise_question(text), model, dimensions or 0)
+        blob = np.asarray(embedding, dtype = np.float32).tobytes()
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)", key + (blob, time.time()))
+            count = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            if count > self.max_entries:
+                # Evict down to 90% so this does not run on every insert once the cache is full
+                evict = count - int(0.9 * self.max_entries)
+                self._connection.execute("DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)", (evict,))
+                logger.log(ANALYSIS_LEVEL, f"Embedding cache: evicted {evict} least recently used entries")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            size = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "size": size,
+                    "max_entries": self.max_entries}
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.log(ANALYSIS_LEVEL, f"Embedding cache: {stats['hits']} hits, {stats['misses']} misses, hit rate {stats['hit_rate']:.1%}, {stats['size']}/{stats['max_entries']} entries")
+
+
+class _CachedEmbeddings:
+    def __init__(self, embeddings, cache):
+        self._embeddings = embeddings
+        self._cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self._embeddings, name)
+
+    def create(self, *, input, model, dimensions = NOT_GIVEN, **kwargs):
+        # Only plain text requests for float vectors are cached. Anything else goes straight to the API
+        texts = [input] if isinstance(input, str) else input
+        if kwargs.get("encoding_format", "float") != "float" or not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+            return self._embeddings.create(input = input, model = model, dimensions = dimensions, **kwargs)
+
+        cache_dimensions = None if dimensions is NOT_GIVEN else dimensions
+        vectors = [self._cache.get(text, model, cache_dimensions) for text in texts]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        usage = Usage(prompt_tokens = 0, total_tokens = 0)
+        if missing:
+            response = self._embeddings.create(input = [texts[i] for i in missing], model = model, dimensions = dimensions, **kwargs)
+            for i, item in zip(missing, sorted(response.data, key = lambda item: item.index)):
+                vectors[i] = item.embedding
+                self._cache.put(texts[i], model, cache_dimensions, item.embedding)
+            usage = response.usage
+
+        return CreateEmbeddingResponse(data = [Embedding(embedding = vector, index = i, object = "embedding") for i, vector in enumerate(vectors)],
+                                       model = model,
+                                       object = "list",
+                                       usage = usage)
+
+
+class CachedEmbeddingsClient:
+    '''
+    Wraps an OpenAI client so that client.embeddings.create is served from an EmbeddingCache when it can be.
+    Everything else, chat completions included, is passed through to the wrapped client.
+    '''
+    def __init__(self, client, cache):
+        self._client = client
+        self.embeddings = _CachedEmbeddings(client.embeddings, cache)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
@@ -1,3 +1,9 @@
+import inspect
+import logging
+import os
+import threading
+import time
+
 from gdpr_rag.documents.gdpr import GDPR
 from gdpr_rag.documents.article_30_5 import Article_30_5
 from gdpr_rag.documents.article_47_bcr import Article_47_BCR
@@ -22,14 +28,79 @@ from gdpr_rag.documents.protection import Protection
 
 
 from regulations_rag.corpus import Corpus , create_document_dictionary_from_folder
+from regulations_rag.document import Document
+
+logger = logging.getLogger(__name__)
+DEV_LEVEL = 15
+logging.addLevelName(DEV_LEVEL, 'DEV')
+
+
+class LazyDocumentDictionary(dict):
+    '''
+    Drop-in for the document dictionary that only instantiates (and so parses the source file of) a document
+    the first time it is looked up. Keys are registered up front so `in`, len() and keys() work without loading anything.
+    '''
+    def __init__(self, document_classes):
+        super().__init__()
+        self._document_classes = dict(document_classes)
+        self._locks = {key: threading.Lock() for key in self._document_classes}
+        for key in self._document_classes:
+            super().__setitem__(key, None)
+
+    def __getitem__(self, key):
+        document = super().__getitem__(key)
+        if document is None:
+            with self._locks[key]:
+                document = super().__getitem__(key)
+                if document is None:
+                    start = time.perf_counter()
+                    document = self._document_classes[key]()
+                    super().__setitem__(key, document)
+                    logger.log(DEV_LEVEL, f"Loaded document {key} in {time.perf_counter() - start:.3f}s")
+        return document
+
+    def get(self, key, default = None):
+        return self[key] if key in self else default
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def is_loaded(self, key):
+        return super().__getitem__(key) is not None
+
+    def load_all(self):
+        for key in self:
+            self[key]
 
 
 class GDPRCorpus(Corpus):
-    def __init__(self, folder):
-        document_dictionary = create_document_dictionary_from_folder(folder, globals())
+    def __init__(self, folder, lazy = False, warm_up = False):
+        '''
+        :param lazy: Only parse a document the first time it is used instead of parsing all of them here
+        :param warm_up: When lazy, load the remaining documents on a background thread
+        '''
+        if lazy:
+            document_dictionary = LazyDocumentDictionary(self._get_document_classes(folder))
+        else:
+            document_dictionary = create_document_dictionary_from_folder(folder, globals())
         super().__init__(document_dictionary)
 
+        if lazy and warm_up:
+            threading.Thread(target = document_dictionary.load_all, name = "corpus_warm_up", daemon = True).start()
+
+    # The same documents create_document_dictionary_from_folder would load: the Document classes imported above whose source file is in folder
+    def _get_document_classes(self, folder):
+        module_names = {os.path.splitext(filename)[0] for filename in os.listdir(folder) if filename.endswith(".py")}
+        document_classes = {}
+        for name, obj in globals().items():
+            if inspect.isclass(obj) and issubclass(obj, Document) and obj is not Document:
+                if os.path.splitext(os.path.basename(inspect.getfile(obj)))[0] in module_names:
+                    document_classes[name] = obj
+        return document_classes
+
     def get_primary_document(self):
         return "GDPR"
 
-
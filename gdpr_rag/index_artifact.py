@@ -0,0 +1,232 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from cryptography.fernet import Fernet
+
+from regulations_rag.file_tools import load_parquet_data
+from gdpr_rag.gdpr_corpus import GDPRCorpus
+from gdpr_rag.sparse_index import build_sparse_index, save_sparse_index, sparse_index_file_name
+from gdpr_rag.token_counts import add_token_counts
+
+# Create a logger for this module
+logger = logging.getLogger(__name__)
+DEV_LEVEL = 15
+logging.addLevelName(DEV_LEVEL, 'DEV')
+
+# Bump this whenever the layout of the files in the artifact folder changes. Artifacts with a different
+# format version are ignored and the index is loaded from the individual files instead
+ARTIFACT_FORMAT_VERSION = 5
+
+default_index_folder = "./inputs/index/"
+default_artifact_folder = "./inputs/index_artifact/"
+
+manifest_file_name = "manifest.json"
+metadata_file_name = "metadata.parquet"      # every column except the embedding, encrypted like the files in inputs/index
+embeddings_file_name = "embeddings.npy"      # contiguous float32 matrix, one row per row in the metadata file
+# sparse_index_file_name: BM25 postings for the rows that are not definitions, see gdpr_rag/sparse_index.py
+
+
+def _timed_load_parquet_data(filepath, key):
+    start = time.perf_counter()
+    df = load_parquet_data(filepath, key)
+    return df, time.perf_counter() - start
+
+
+def load_index_folder(index_folder, key, mode = "thread", max_workers = None):
+    '''
+    Decrypts every parquet file in index_folder and returns them as a single DataFrame.
+
+    :param mode: "thread" (default) or "process" to decrypt and decode the files on a pool, or "sequential".
+                 Decryption and parquet decoding mostly run outside the GIL so threads are usually enough.
+    :param max_workers: Size of the pool. Defaults to the executor's own default.
+    '''
+    filepaths = [os.path.join(index_folder, filename) for filename in sorted(os.listdir(index_folder)) if filename.endswith(".parquet")]
+    if not filepaths:
+        return pd.DataFrame()
+
+    start = time.perf_counter()
+    if mode == "sequential":
+        results = [_timed_load_parquet_data(filepath, key) for filepath in filepaths]
+    elif mode in ("thread", "process"):
+        executor_class = ThreadPoolExecutor if mode == "thread" else ProcessPoolExecutor
+        with executor_class(max_workers = max_workers) as executor:
+            results = list(executor.map(_timed_load_parquet_data, filepaths, [key] * len(filepaths)))
+    else:
+        raise ValueError(f"Unknown load mode {mode}. Use one of 'thread', 'process' or 'sequential'")
+
+    for filepath, (df, seconds) in zip(filepaths, results):
+        logger.log(DEV_LEVEL, f"Loaded {os.path.basename(filepath)} ({len(df)} rows) in {seconds:.3f}s")
+    index_df = pd.concat([df for df, _ in results], ignore_index = True)
+    logger.log(DEV_LEVEL, f"Loaded {len(filepaths)} index files in {time.perf_counter() - start:.3f}s using mode '{mode}'")
+    return index_df
+
+
+def index_folder_fingerprint(index_folder):
+    '''
+    A cheap version string for an index that was loaded from the individual files
+    '''
+    fingerprint = hashlib.sha256()
+    for filename in sorted(os.listdir(index_folder)):
+        if filename.endswith(".parquet"):
+            stat = os.stat(os.path.join(index_folder, filename))
+            fingerprint.update(f"{filename}|{stat.st_size}|{stat.st_mtime_ns}\n".encode("utf-8"))
+    return fingerprint.hexdigest()[:16]
+
+
+def source_file_fingerprints(index_folder):
+    '''
+    The size and content hash of every parquet file in index_folder. Stored in the manifest so an artifact that was
+    built from different index files is not used. File times are not used because a checkout or a deploy changes them
+    '''
+    fingerprints = {}
+    for filename in sorted(os.listdir(index_folder)):
+        if filename.endswith(".parquet"):
+            with open(os.path.join(index_folder, filename), "rb") as file:
+                content = file.read()
+            fingerprints[filename] = f"{len(content)}:{hashlib.sha256(content).hexdigest()}"
+    return fingerprints
+
+
+def add_definition_text(index_df, gdpr):
+    '''
+    Adds a 'definition' column with the text of each GDPR definition ('' for rows that are not definitions)
+    '''
+    index_df = index_df.copy()
+    is_definition = index_df['source'] == 'definitions'
+    references = index_df.loc[is_definition, 'section_reference'].apply(gdpr.reference_checker.remove_prefix)
+    definition = references.map(gdpr.get_definition_texts())
+    # Anything that is not an Article 4 definition still goes through get_text
+    missing = definition.isna()
+    if missing.any():
+        fallback = references[missing].apply(lambda x: gdpr.get_text(section_reference = x, add_markdown_decorators = False, add_headings = False))
+        # ... except the get_text method adds some stuff before the defn so I strip it out
+        definition[missing] = fallback.str.replace(r'^\s*\d+\.\s*', '', regex=True)
+    index_df['definition'] = ''
+    index_df.loc[is_definition, 'definition'] = definition
+    return index_df
+
+
+def _write_atomically(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+
+def build_index_artifact(key, index_folder = default_index_folder, artifact_folder = default_artifact_folder):
+    '''
+    Offline build step that consolidates the per-document index files into one artifact that can be
+    loaded with a single memory map. The text columns stay encrypted with the same key as the source
+    files. The embeddings are stored unencrypted as a float32 matrix so they can be memory-mapped.
+    The text of each definition, the token count of the document section each row points to, and the
+    sparse (BM25) index used for hybrid retrieval are materialised at build time so they do not have to be rebuilt
+    on start-up.
+
+    Returns the manifest that was written.
+    '''
+    index_df = load_index_folder(index_folder, key)
+    if len(index_df) == 0:
+        raise ValueError(f"No index files found in {index_folder}")
+    corpus = GDPRCorpus("./gdpr_rag/documents/")
+    index_df = add_definition_text(index_df, corpus.get_document("GDPR"))
+    index_df = add_token_counts(index_df, corpus)
+    # Definitions first, so the definition and section rows are each one contiguous block of the embedding matrix and
+    # the vector index can search the memory map without copying it
+    is_definition = index_df["source"] == "definitions"
+    index_df = pd.concat([index_df[is_definition], index_df[~is_definition]], ignore_index = True)
+
+    embeddings = np.ascontiguousarray(np.vstack(index_df["embedding"].to_numpy()), dtype = np.float32)
+    metadata = index_df.drop(columns = ["embedding"])
+
+    buffer = io.BytesIO()
+    metadata.to_parquet(buffer, engine = "pyarrow", index = False)
+    metadata_bytes = buffer.getvalue()
+
+    version = hashlib.sha256()
+    version.update(metadata_bytes)
+    version.update(embeddings.tobytes())
+
+    manifest = {
+        "format_version": ARTIFACT_FORMAT_VERSION,
+        "version": version.hexdigest()[:16],
+        "rows": int(embeddings.shape[0]),
+        "dimensions": int(embeddings.shape[1]),
+        "dtype": "float32",
+        "columns": metadata.columns.to_list(),
+        "source_files": source_file_fingerprints(index_folder),
+        "sparse_index": sparse_index_file_name,
+    }
+
+    os.makedirs(artifact_folder, exist_ok = True)
+    _write_atomically(os.path.join(artifact_folder, metadata_file_name), Fernet(key).encrypt(metadata_bytes))
+    embeddings_buffer = io.BytesIO()
+    np.save(embeddings_buffer, embeddings)
+    _write_atomically(os.path.join(artifact_folder, embeddings_file_name), embeddings_buffer.getvalue())
+    # Same rows, in the same order, as the index frame GDPRCorpusIndex builds from the artifact
+    sections = metadata[metadata["source"] != "definitions"].reset_index(drop = True)
+    save_sparse_index(build_sparse_index(sections, corpus), artifact_folder, manifest["version"])
+    # The manifest goes last so a half written artifact is never picked up
+    _write_atomically(os.path.join(artifact_folder, manifest_file_name), json.dumps(manifest, indent = 2).encode("utf-8"))
+
+    logger.log(DEV_LEVEL, f"Wrote index artifact version {manifest['version']} with {manifest['rows']} rows to {artifact_folder}")
+    return manifest
+
+
+def read_manifest(artifact_folder = default_artifact_folder, index_folder = default_index_folder):
+    '''
+    Returns the manifest of the artifact in artifact_folder or None if there is no usable artifact, including when
+    the files in index_folder are not the ones it was built from
+    '''
+    manifest_path = os.path.join(artifact_folder, manifest_file_name)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, "r", encoding = "utf-8") as file:
+        manifest = json.load(file)
+    if manifest.get("format_version") != ARTIFACT_FORMAT_VERSION:
+        logger.warning(f"Ignoring the index artifact in {artifact_folder}. It has format version {manifest.get('format_version')} but {ARTIFACT_FORMAT_VERSION} is required")
+        return None
+    if os.path.isdir(index_folder) and manifest.get("source_files") != source_file_fingerprints(index_folder):
+        logger.warning(f"Ignoring the index artifact in {artifact_folder}. It was not built from the current files in {index_folder}. Rebuild it with python -m gdpr_rag.index_artifact")
+        return None
+    return manifest
+
+
+def load_index_artifact(key, artifact_folder = default_artifact_folder, index_folder = default_index_folder, manifest = None):
+    '''
+    Returns (index_df, manifest) or None if there is no usable artifact in artifact_folder. Pass the manifest if
+    read_manifest has already been called so the source files are not checked twice.
+
+    The embedding column of index_df holds read-only views into the memory-mapped matrix so
+    nothing is copied until a row is actually used.
+    '''
+    if manifest is None:
+        manifest = read_manifest(artifact_folder, index_folder)
+    if manifest is None:
+        return None
+
+    with open(os.path.join(artifact_folder, metadata_file_name), "rb") as file:
+        metadata_bytes = Fernet(key).decrypt(file.read())
+    index_df = pd.read_parquet(io.BytesIO(metadata_bytes), engine = "pyarrow")
+
+    embeddings = np.load(os.path.join(artifact_folder, embeddings_file_name), mmap_mode = "r")
+    if embeddings.shape != (manifest["rows"], manifest["dimensions"]) or len(index_df) != manifest["rows"]:
+        logger.warning(f"Ignoring the index artifact in {artifact_folder}. Its files do not match the manifest")
+        return None
+
+    index_df["embedding"] = list(embeddings)
+    return index_df, manifest
+
+
+if __name__ == "__main__":
+    # python -m gdpr_rag.index_artifact
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level = DEV_LEVEL)
+    build_index_artifact(os.getenv("DECRYPTION_KEY_GDPR"))
@@ -0,0 +1,129 @@
+import logging
+import math
+import re
+from collections import Counter
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+DEV_LEVEL = 15
+logging.addLevelName(DEV_LEVEL, 'DEV')
+
+# "Article 30(5)" -> ["article", "30", "5", "30(5)"]: the full reference is kept as a term of its own so an exact
+# reference in a question matches the sections that quote it
+_reference_pattern = re.compile(r'\b\d{1,3}(?:\([0-9a-z]{1,3}\))+')
+_word_pattern = re.compile(r'[a-z0-9]+')
+_stop_words = frozenset(["a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "how", "i", "if",
+                         "in", "is", "it", "my", "of", "on", "or", "our", "that", "the", "this", "to", "we", "what", "when",
+                         "which", "who", "with", "you"])
+
+
+def tokenise(text):
+    text = text.lower()
+    return [word for word in _word_pattern.findall(text) if word not in _stop_words] + _reference_pattern.findall(text)
+
+
+class BM25Index:
+    '''
+    Okapi BM25 over a list of texts, stored as one posting list (row positions and term frequencies) per term.
+    scores() only touches the postings of the terms in the question, so it costs microseconds per question.
+    '''
+    def __init__(self, texts, k1 = 1.2, b = 0.75):
+        self.k1 = k1
+        self.b = b
+        postings = {}
+        lengths = np.zeros(len(texts), dtype = np.float32)
+        for position, text in enumerate(texts):
+            terms = tokenise(text)
+            lengths[position] = len(terms)
+            for term, frequency in Counter(terms).items():
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(position)
+                postings[term][1].append(frequency)
+        self.lengths = lengths
+        self.average_length = float(lengths.mean()) if len(lengths) and lengths.mean() > 0 else 1.0
+        self.postings = {term: (np.array(rows, dtype = np.int32), np.array(frequencies, dtype = np.float32))
+                         for term, (rows, frequencies) in postings.items()}
+        n = len(texts)
+        self.idf = {term: math.log(1 + (n - len(rows) + 0.5) / (len(rows) + 0.5)) for term, (rows, _) in self.postings.items()}
+        logger.log(DEV_LEVEL, f"Built a BM25 index over {n} texts with {len(self.postings)} terms")
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def to_arrays(self):
+        '''
+        The index as a dict of numpy arrays (the postings of all terms concatenated) that np.savez can write
+        '''
+        terms = sorted(self.postings)
+        counts = np.array([len(self.postings[term][0]) for term in terms], dtype = np.int64)
+        return {"terms": np.array(terms, dtype = str),
+                "offsets": np.concatenate([[0], np.cumsum(counts)]),
+                "rows": np.concatenate([self.postings[term][0] for term in terms]) if terms else np.zeros(0, dtype = np.int32),
+                "frequencies": np.concatenate([self.postings[term][1] for term in terms]) if terms else np.zeros(0, dtype = np.float32),
+                "lengths": self.lengths,
+                "parameters": np.array([self.k1, self.b], dtype = np.float64)}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        index = cls.__new__(cls)
+        index.k1, index.b = (float(value) for value in arrays["parameters"])
+        index.lengths = arrays["lengths"]
+        index.average_length = float(index.lengths.mean()) if len(index.lengths) and index.lengths.mean() > 0 else 1.0
+        offsets, rows, frequencies = arrays["offsets"], arrays["rows"], arrays["frequencies"]
+        index.postings = {str(term): (rows[offsets[i]:offsets[i + 1]], frequencies[offsets[i]:offsets[i + 1]]) for i, term in enumerate(arrays["terms"])}
+        n = len(index.lengths)
+        index.idf = {term: math.log(1 + (n - len(rows) + 0.5) / (len(rows) + 0.5)) for term, (rows, _) in index.postings.items()}
+        return index
+
+    def scores(self, question, positions = None):
+        '''
+        BM25 score of every row, or only of the rows at positions, for question
+        '''
+        scores = np.zeros(len(self), dtype = np.float32)
+        for term in set(tokenise(question)):
+            if term not in self.postings:
+                continue
+            rows, frequencies = self.postings[term]
+            length_norm = self.k1 * (1 - self.b + self.b * self.lengths[rows] / self.average_length)
+            scores[rows] += self.idf[term] * frequencies * (self.k1 + 1) / (frequencies + length_norm)
+        return scores if positions is None else scores[positions]
+
+
+class BM25Rerank:
+    '''
+    CPU only alternative to RerankAlgos.LLM. Pass it as the rerank_algo of the chat and GDPRCorpusIndex.get_relevant_sections
+    uses it to choose which of the sections under the embedding threshold are kept, instead of asking the LLM.
+
+    Each candidate is scored with embedding_weight * cosine similarity + (1 - embedding_weight) * BM25 score, both
+    scaled to [0, 1] over the candidates. The best top_k are kept, in score order, up to final_token_cap tokens.
+    embedding_weight = 0 is a pure BM25 rerank.
+    '''
+    def __init__(self, embedding_weight = 0.5, top_k = 10, final_token_cap = 5000):
+        self.params = {"embedding_weight": embedding_weight, "top_k": top_k, "final_token_cap": final_token_cap}
+
+    def select(self, question, positions, distances, bm25_index, section_token_counts):
+        '''
+        Returns the subset of positions (the rows of the index that passed the threshold, with their cosine
+        distances) that should be sent on to generation, best first. section_token_counts is called with an array of
+        positions and returns the number of tokens the section each of them points to adds to the prompt. It is only
+        called for the top_k rows.
+        '''
+        if len(positions) == 0:
+            return positions
+        def scaled(values):
+            spread = values.max() - values.min()
+            return (values - values.min()) / spread if spread > 0 else np.ones_like(values)
+        weight = self.params["embedding_weight"]
+        fused = weight * scaled(1.0 - np.asarray(distances, dtype = np.float32)) + (1 - weight) * scaled(bm25_index.scores(question, positions))
+        order = np.argsort(-fused, kind = "stable")[:self.params["top_k"]]
+        counts = section_token_counts(positions[order])
+
+        selected = []
+        tokens = 0
+        for i, count in zip(order, counts):
+            tokens += count
+            if selected and tokens > self.params["final_token_cap"]:
+                break
+            selected.append(positions[i])
+        return np.array(selected, dtype = positions.dtype)
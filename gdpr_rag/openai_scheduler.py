@@ -0,0 +1,204 @@
+import contextlib
+import contextvars
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+import openai
+from tenacity import Retrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+from gdpr_rag.token_counts import token_counter
+
+logger = logging.getLogger(__name__)
+DEV_LEVEL = 15
+ANALYSIS_LEVEL = 25
+logging.addLevelName(DEV_LEVEL, 'DEV')
+logging.addLevelName(ANALYSIS_LEVEL, 'ANALYSIS')
+
+default_max_in_flight = 8
+# Requests from one lane (one chat session) are served in order. Lanes take turns
+scheduler_lane = contextvars.ContextVar("scheduler_lane", default = "default")
+
+
+class RequestScheduler:
+    '''
+    Admission control for every OpenAI call the process makes: at most max_in_flight calls at once and, when
+    tokens_per_minute is set, at most that many (estimated) tokens started in any 60 second window.
+
+    Waiting calls are queued per lane and the lanes are served round-robin, so one busy session cannot hold
+    up the others. A single call bigger than the whole budget is let through when nothing else is in the window.
+    '''
+    def __init__(self, max_in_flight = default_max_in_flight, tokens_per_minute = None):
+        self.max_in_flight = max_in_flight
+        self.tokens_per_minute = tokens_per_minute
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._waiting = OrderedDict() # lane -> deque of tickets, in the order the lanes will be served
+        self._window = deque()        # (start time, tokens) of the calls started in the last 60 seconds
+        self._window_tokens = 0
+        self.granted = 0
+        self.total_wait = 0.0
+
+    def _expire_window(self, now):
+        while self._window and now - self._window[0][0] >= 60.0:
+            self._window_tokens -= self._window.popleft()[1]
+
+    def _can_start(self, tokens, now):
+        if self._in_flight >= self.max_in_flight:
+            return False
+        if self.tokens_per_minute is None:
+            return True
+        self._expire_window(now)
+        return self._window_tokens == 0 or self._window_tokens + tokens <= self.tokens_per_minute
+
+    def _seconds_until_window_frees(self, now):
+        return max(0.05, 60.0 - (now - self._window[0][0])) if self._window else None
+
+    @contextlib.contextmanager
+    def slot(self, lane, tokens):
+        ticket = object()
+        start = time.monotonic()
+        with self._condition:
+            self._waiting.setdefault(lane, deque()).append(ticket)
+            while True:
+                now = time.monotonic()
+                next_lane = next(iter(self._waiting))
+                if self._waiting[next_lane][0] is ticket and self._can_start(tokens, now):
+                    break
+                self._condition.wait(timeout = self._seconds_until_window_frees(now))
+            self._waiting[lane].popleft()
+            if self._waiting[lane]:
+                self._waiting.move_to_end(lane)
+            else:
+                del self._waiting[lane]
+            self._in_flight += 1
+            self._window.append((now, tokens))
+            self._window_tokens += tokens
+            waited = now - start
+            self.granted += 1
+            self.total_wait += waited
+            # The next ticket in line may be able to start as well
+            self._condition.notify_all()
+        if waited > 1.0:
+            logger.log(DEV_LEVEL, f"OpenAI call from lane {lane} waited {waited:.1f}s for a slot")
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {"granted": self.granted,
+                    "mean_wait": self.total_wait / self.granted if self.granted else 0.0,
+                    "in_flight": self._in_flight,
+                    "waiting": sum(len(tickets) for tickets in self._waiting.values()),
+                    "window_tokens": self._window_tokens}
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.log(ANALYSIS_LEVEL, f"OpenAI scheduler: {stats['granted']} calls, mean wait {stats['mean_wait']:.2f}s, {stats['in_flight']} in flight, {stats['waiting']} waiting, {stats['window_tokens']} tokens in the last minute")
+
+
+# The client is made with max_retries = 0 so that every retry goes through the scheduler. Rate limits get more attempts
+# than the errors the SDK itself would have retried twice: connection errors, timeouts and 5xx responses
+retried_errors = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) # APITimeoutError is an APIConnectionError
+max_attempts_rate_limited = 6
+max_attempts_other = 3
+
+
+def _stop(retry_state):
+    error = retry_state.outcome.exception()
+    max_attempts = max_attempts_rate_limited if isinstance(error, openai.RateLimitError) else max_attempts_other
+    return stop_after_attempt(max_attempts)(retry_state)
+
+
+def _retrying():
+    # Retried with jittered exponential backoff. The slot is given back while waiting
+    return Retrying(retry = retry_if_exception_type(retried_errors),
+                    wait = wait_random_exponential(multiplier = 1, max = 30),
+                    stop = _stop,
+                    before_sleep = lambda retry_state: logger.warning(f"OpenAI call failed with {type(retry_state.outcome.exception()).__name__}. Retry {retry_state.attempt_number} in {retry_state.next_action.sleep:.1f}s"),
+                    reraise = True)
+
+
+def _scheduled_call(scheduler, create, tokens, kwargs):
+    for attempt in _retrying():
+        with attempt:
+            with scheduler.slot(scheduler_lane.get(), tokens):
+                return create(**kwargs)
+
+
+def _scheduled_stream(scheduler, create, tokens, kwargs):
+    # A stream holds its slot until it has been read to the end
+    for attempt in _retrying():
+        with attempt:
+            stack = contextlib.ExitStack()
+            stack.enter_context(scheduler.slot(scheduler_lane.get(), tokens))
+            try:
+                stream = create(**kwargs)
+            except BaseException:
+                stack.close()
+                raise
+    def read():
+        with stack:
+            yield from stream
+    return read()
+
+
+class _ScheduledCompletions:
+    def __init__(self, completions, scheduler):
+        self._completions = completions
+        self._scheduler = scheduler
+
+    def __getattr__(self, name):
+        return getattr(self._completions, name)
+
+    def create(self, **kwargs):
+        # Prompts hold the sections retrieved for one question, so they are counted without filling the memoised counter
+        tokens = sum(token_counter.count(message.get("content") or "", memoise = False) if isinstance(message.get("content"), str) else 0
+                     for message in kwargs.get("messages", []))
+        tokens += kwargs.get("max_tokens") or 0
+        if kwargs.get("stream"):
+            return _scheduled_stream(self._scheduler, self._completions.create, tokens, kwargs)
+        return _scheduled_call(self._scheduler, self._completions.create, tokens, kwargs)
+
+
+class _ScheduledChat:
+    def __init__(self, chat, scheduler):
+        self._chat = chat
+        self.completions = _ScheduledCompletions(chat.completions, scheduler)
+
+    def __getattr__(self, name):
+        return getattr(self._chat, name)
+
+
+class _ScheduledEmbeddings:
+    def __init__(self, embeddings, scheduler):
+        self._embeddings = embeddings
+        self._scheduler = scheduler
+
+    def __getattr__(self, name):
+        return getattr(self._embeddings, name)
+
+    def create(self, **kwargs):
+        texts = [kwargs["input"]] if isinstance(kwargs.get("input"), str) else kwargs.get("input", [])
+        tokens = sum(token_counter.count(text, memoise = False) for text in texts if isinstance(text, str))
+        return _scheduled_call(self._scheduler, self._embeddings.create, tokens, kwargs)
+
+
+class ScheduledOpenAIClient:
+    '''
+    Wraps one (pooled) OpenAI client so that its chat completions and embeddings calls go through a RequestScheduler,
+    in the lane given by the scheduler_lane context variable. Share one instance across the whole process.
+    '''
+    def __init__(self, client, scheduler):
+        self._client = client
+        self.scheduler = scheduler
+        self.chat = _ScheduledChat(client.chat, scheduler)
+        self.embeddings = _ScheduledEmbeddings(client.embeddings, scheduler)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
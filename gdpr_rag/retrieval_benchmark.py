@@ -0,0 +1,133 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from gdpr_rag.vector_index import create_vector_index
+
+default_backends = {
+    "exact": ("exact", {}),
+    "ivf (n_probe=8)": ("ivf", {"n_probe": 8}),
+    "int8": ("int8", {}),
+    "truncated 256 (n_candidates=100)": ("truncated", {"coarse_dimensions": 256, "n_candidates": 100}),
+    "truncated 256 (n_candidates=200)": ("truncated", {"coarse_dimensions": 256, "n_candidates": 200}),
+}
+
+
+def benchmark_vector_backends(embeddings, query_embeddings, threshold, backends = None, repeats = 3):
+    '''
+    Searches every query with every backend and compares each result with the "exact" backend.
+
+    Returns a DataFrame with one row per backend: build time, mean and 95th percentile query latency and recall,
+    which is the share of the rows the exact search returns under the threshold that the backend also returns.
+    '''
+    backends = backends or default_backends
+    exact = create_vector_index(embeddings, "exact")
+    expected = [set(exact.search(query, threshold)[0]) for query in query_embeddings]
+
+    results = []
+    for name, (backend, params) in backends.items():
+        start = time.perf_counter()
+        index = create_vector_index(embeddings, backend, **params)
+        build_seconds = time.perf_counter() - start
+
+        latencies = []
+        found = 0
+        for query, expected_positions in zip(query_embeddings, expected):
+            for _ in range(repeats):
+                start = time.perf_counter()
+                positions, _ = index.search(query, threshold)
+                latencies.append(time.perf_counter() - start)
+            found += len(expected_positions & set(positions))
+        total_expected = sum(len(positions) for positions in expected)
+
+        results.append({"backend": name,
+                        "build_seconds": build_seconds,
+                        "mean_ms": 1000 * np.mean(latencies),
+                        "p95_ms": 1000 * np.percentile(latencies, 95),
+                        "recall": found / total_expected if total_expected else 1.0})
+    return pd.DataFrame(results)
+
+
+def _selected_sections(relevant_sections):
+    columns = [column for column in ["document", "section_reference"] if column in relevant_sections.columns] or ["text"]
+    return set(relevant_sections[columns].itertuples(index = False, name = None))
+
+
+def compare_rerankers(corpus_index, questions, query_embeddings, threshold, rerank_algos, reference = None):
+    '''
+    Runs corpus_index.get_relevant_sections for every question with every rerank algorithm in rerank_algos
+    ({name: rerank_algo}) and compares the sections each one keeps with the ones the reference algorithm keeps.
+
+    Returns a DataFrame with one row per algorithm: mean and 95th percentile latency, the mean number of sections
+    kept and the precision / recall of those sections against the reference (usually the LLM rerank).
+    '''
+    reference = reference or next(iter(rerank_algos))
+    selections = {}
+    latencies = {}
+    for name, rerank_algo in rerank_algos.items():
+        selections[name], latencies[name] = [], []
+        for question, embedding in zip(questions, query_embeddings):
+            start = time.perf_counter()
+            relevant_sections = corpus_index.get_relevant_sections(question, embedding, threshold, rerank_algo)
+            latencies[name].append(time.perf_counter() - start)
+            selections[name].append(_selected_sections(relevant_sections))
+
+    results = []
+    for name in rerank_algos:
+        kept = sum(len(selected) for selected in selections[name])
+        expected = sum(len(selected) for selected in selections[reference])
+        agreed = sum(len(selected & expected_selected) for selected, expected_selected in zip(selections[name], selections[reference]))
+        results.append({"rerank": name,
+                        "mean_ms": 1000 * np.mean(latencies[name]),
+                        "p95_ms": 1000 * np.percentile(latencies[name], 95),
+                        "mean_sections": kept / len(questions) if questions else 0.0,
+                        f"precision_vs_{reference}": agreed / kept if kept else 1.0,
+                        f"recall_vs_{reference}": agreed / expected if expected else 1.0})
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+    # python -m gdpr_rag.retrieval_benchmark questions.txt --threshold 0.55 [--rerank]
+    # questions.txt holds one question per line, e.g. the user questions from the session logs
+    from dotenv import load_dotenv
+    from openai import OpenAI
+    from regulations_rag.rerank import RerankAlgos
+    from gdpr_rag.corpus_index import GDPRCorpusIndex
+    from gdpr_rag.lexical_rerank import BM25Rerank
+
+    parser = argparse.ArgumentParser(description = "Compare the latency and recall of the vector index backends on a question set")
+    parser.add_argument("questions", help = "text file with one question per line")
+    parser.add_argument("--threshold", type = float, required = True, help = "cosine distance threshold, as used for section retrieval")
+    parser.add_argument("--model", default = "text-embedding-3-large")
+    parser.add_argument("--dimensions", type = int, default = 1024)
+    parser.add_argument("--rerank", action = "store_true", help = "also compare the BM25 rerank with the LLM rerank. This calls the LLM for every question")
+    args = parser.parse_args()
+
+    load_dotenv()
+    with open(args.questions, "r", encoding = "utf-8") as file:
+        questions = [line.strip() for line in file if line.strip()]
+
+    client = OpenAI(api_key = os.getenv("OPENAI_API_KEY_GDPR"))
+    response = client.embeddings.create(input = questions, model = args.model, dimensions = args.dimensions)
+    query_embeddings = [np.array(item.embedding, dtype = np.float32) for item in response.data]
+
+    corpus_index = GDPRCorpusIndex(os.getenv("DECRYPTION_KEY_GDPR"), lazy_corpus = True)
+    section_embeddings = list(corpus_index.index["embedding"])
+    print(f"{len(questions)} questions against {len(section_embeddings)} index rows at threshold {args.threshold}")
+    print(benchmark_vector_backends(section_embeddings, query_embeddings, args.threshold).to_string(index = False))
+
+    if args.rerank:
+        rerank_algo = RerankAlgos.LLM
+        rerank_algo.params["openai_client"] = client
+        rerank_algo.params["model_to_use"] = "gpt-4o"
+        rerank_algo.params["user_type"] = corpus_index.user_type
+        rerank_algo.params["corpus_description"] = corpus_index.corpus_description
+        rerank_algo.params["final_token_cap"] = 5000
+        rerank_algos = {"llm": rerank_algo,
+                        "bm25": BM25Rerank(embedding_weight = 0.0),
+                        "bm25 + embedding": BM25Rerank(embedding_weight = 0.5),
+                        "none": RerankAlgos.NONE}
+        print(compare_rerankers(corpus_index, questions, query_embeddings, args.threshold, rerank_algos).to_string(index = False))
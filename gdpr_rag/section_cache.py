@@ -0,0 +1,85 @@
+import functools
+import inspect
+import logging
+import threading
+
+from cachetools import LRUCache
+
+logger = logging.getLogger(__name__)
+ANALYSIS_LEVEL = 25
+logging.addLevelName(ANALYSIS_LEVEL, 'ANALYSIS')
+
+default_maxsize = 4096
+
+
+class SectionCache:
+    '''
+    Process-wide, bounded LRU cache for rendered document text. The documents are read-only once loaded so
+    the output of get_text / get_heading only depends on the document instance and the arguments.
+    '''
+    def __init__(self, maxsize = default_maxsize):
+        self._cache = LRUCache(maxsize = maxsize)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_render(self, key, render):
+        with self._lock:
+            try:
+                value = self._cache[key]
+                self.hits += 1
+                return value
+            except KeyError:
+                self.misses += 1
+        # Render outside the lock. Two sessions asking for the same new section at once both render it, which is harmless
+        value = render()
+        with self._lock:
+            self._cache[key] = value
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "size": len(self._cache),
+                    "maxsize": self._cache.maxsize}
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.log(ANALYSIS_LEVEL, f"Section cache: {stats['hits']} hits, {stats['misses']} misses, hit rate {stats['hit_rate']:.1%}, {stats['size']}/{stats['maxsize']} entries")
+
+
+section_cache = SectionCache()
+
+
+def cached_section(method):
+    '''
+    Decorator for Document.get_text and Document.get_heading that serves repeat calls from section_cache.
+
+    Arguments are bound to the method signature (with defaults applied) so positional and keyword calls
+    share an entry. Each document instance gets its own token in the key so two instances of the same
+    class, e.g. loaded from different files, never see each other's text.
+    '''
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        token = self.__dict__.setdefault('_section_cache_token', object())
+        key = (token, method.__name__) + tuple(bound.arguments.values())[1:]
+        try:
+            hash(key)
+        except TypeError:
+            return method(self, *args, **kwargs)
+        return section_cache.get_or_render(key, lambda: method(self, *args, **kwargs))
+
+    return wrapper
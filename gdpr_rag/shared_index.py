@@ -0,0 +1,107 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+try:
+    import fcntl
+except ImportError:
+    # Windows. Publishing is then not locked against other processes, which SHARED_INDEX is meant for on a Linux host
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+DEV_LEVEL = 15
+logging.addLevelName(DEV_LEVEL, 'DEV')
+
+# Publishes the read-only index frames once per host so that every app process on that host maps the same pages
+# instead of holding its own pandas copy. The text columns are written as Arrow IPC files and read back with
+# pa.memory_map, so the returned DataFrames are backed by the mapped buffers (pd.ArrowDtype columns). The embeddings
+# are written as float32 .npy files and memory-mapped.
+#
+# The published files hold decrypted text so they live in a folder only the current user can read, on tmpfs
+# (/dev/shm) where it exists so nothing is written to disk.
+
+default_shared_folder = "/dev/shm/gdpr_rag" if os.path.isdir("/dev/shm") else os.path.join(tempfile.gettempdir(), "gdpr_rag")
+
+manifest_file_name = "manifest.json"
+frame_names = ["definitions", "index"]
+
+
+def _key_check(key):
+    if isinstance(key, str):
+        key = key.encode("utf-8")
+    return hashlib.sha256(b"gdpr_rag shared index|" + key).hexdigest()
+
+
+def _write_frame(df, folder, name):
+    embeddings = np.ascontiguousarray(np.vstack(df["embedding"].to_numpy()), dtype = np.float32) if len(df) else np.zeros((0, 0), dtype = np.float32)
+    np.save(os.path.join(folder, f"{name}_embeddings.npy"), embeddings)
+    table = pa.Table.from_pandas(df.drop(columns = ["embedding"]), preserve_index = False)
+    with pa.OSFile(os.path.join(folder, f"{name}.arrow"), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def _read_frame(folder, name):
+    # read_all() on a memory map does not copy the buffers and ArrowDtype keeps them that way in pandas
+    table = pa.ipc.open_file(pa.memory_map(os.path.join(folder, f"{name}.arrow"), "r")).read_all()
+    df = table.to_pandas(types_mapper = pd.ArrowDtype)
+    embeddings = np.load(os.path.join(folder, f"{name}_embeddings.npy"), mmap_mode = "r")
+    df["embedding"] = list(embeddings) if len(df) else []
+    return df
+
+
+def attach_shared_index(version, key, shared_folder = default_shared_folder):
+    '''
+    Returns {"definitions": DataFrame, "index": DataFrame} backed by the published files for this index version,
+    or None if this version has not been published yet
+    '''
+    folder = os.path.join(shared_folder, version)
+    manifest_path = os.path.join(folder, manifest_file_name)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, "r", encoding = "utf-8") as file:
+        manifest = json.load(file)
+    if manifest.get("key_check") != _key_check(key):
+        logger.warning(f"Not attaching to the shared index in {folder}. It was published with a different key")
+        return None
+    frames = {name: _read_frame(folder, name) for name in frame_names}
+    logger.log(DEV_LEVEL, f"Attached to shared index version {version} in {folder}")
+    return frames
+
+
+def publish_shared_index(frames, version, key, shared_folder = default_shared_folder):
+    '''
+    Publishes {"definitions": DataFrame, "index": DataFrame} for this index version unless another process already
+    has, and removes the files of other versions. Processes that still map old files keep them until they exit.
+    '''
+    os.makedirs(shared_folder, mode = 0o700, exist_ok = True)
+    with open(os.path.join(shared_folder, ".lock"), "w") as lock_file:
+        # Only one process publishes. The others wait here and then find the manifest
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            folder = os.path.join(shared_folder, version)
+            if not os.path.isfile(os.path.join(folder, manifest_file_name)):
+                tmp_folder = tempfile.mkdtemp(dir = shared_folder)
+                for name in frame_names:
+                    _write_frame(frames[name], tmp_folder, name)
+                with open(os.path.join(tmp_folder, manifest_file_name), "w", encoding = "utf-8") as file:
+                    json.dump({"version": version, "key_check": _key_check(key)}, file)
+                shutil.rmtree(folder, ignore_errors = True)
+                os.rename(tmp_folder, folder)
+                logger.log(DEV_LEVEL, f"Published shared index version {version} to {folder}")
+
+            for other in os.listdir(shared_folder):
+                other_folder = os.path.join(shared_folder, other)
+                if other != version and os.path.isdir(other_folder):
+                    shutil.rmtree(other_folder, ignore_errors = True)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,87 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+ANALYSIS_LEVEL = 25
+logging.addLevelName(ANALYSIS_LEVEL, 'ANALYSIS')
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self._lock = threading.Lock()
+        self._deltas = []
+        self._subscribers = []
+
+    def publish(self, delta):
+        '''
+        Passes a partial result (e.g. a piece of a streamed answer) to everyone waiting on this flight
+        '''
+        # Delivered under the lock so every subscriber sees the deltas in order. Subscribers must not block
+        with self._lock:
+            self._deltas.append(delta)
+            for subscriber in self._subscribers:
+                subscriber(delta)
+
+    def subscribe(self, subscriber):
+        # Whatever was published before subscribing is replayed first
+        with self._lock:
+            for delta in self._deltas:
+                subscriber(delta)
+            self._subscribers.append(subscriber)
+
+
+class SingleFlight:
+    '''
+    Coalesces concurrent calls with the same key: the first caller (the leader) runs the computation and every caller
+    that arrives with the same key while it is running waits for, and gets, the leader's result (or exception).
+    Nothing is kept once the leader finishes, so this is not a cache.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, compute, join = None):
+        '''
+        Returns (result, is_leader). compute is called with the flight so it can publish partial results; join,
+        if given, is called with the flight by callers that wait on another caller's computation, before they wait.
+        '''
+        with self._lock:
+            flight = self._flights.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = _Flight()
+                self._flights[key] = flight
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+
+        if is_leader:
+            try:
+                flight.result = compute(flight)
+            except BaseException as e:
+                flight.error = e
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+        else:
+            if join is not None:
+                join(flight)
+            flight.done.wait()
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.result, is_leader
+
+    def log_stats(self):
+        with self._lock:
+            calls = self.leaders + self.coalesced
+            logger.log(ANALYSIS_LEVEL, f"Single flight: {self.coalesced} of {calls} calls coalesced ({self.coalesced / calls if calls else 0.0:.1%})")
+
+
+single_flight = SingleFlight()
@@ -0,0 +1,75 @@
+import logging
+import os
+import time
+
+import numpy as np
+
+from gdpr_rag.lexical_rerank import BM25Index
+
+logger = logging.getLogger(__name__)
+DEV_LEVEL = 15
+logging.addLevelName(DEV_LEVEL, 'DEV')
+
+# Written next to the dense artifact by gdpr_rag/index_artifact.py. It holds term postings and row lengths only,
+# not the text itself
+sparse_index_file_name = "sparse_index.npz"
+
+default_rrf_k = 60
+
+
+def sparse_texts(index_df, corpus):
+    '''
+    The text that is indexed for each row of the index: the row's own text followed by the content of the section
+    it points to in the document (with its heading), so exact terms and article numbers from either can match
+    '''
+    section_content = {}
+    texts = []
+    has_document = "document" in index_df.columns
+    for row_text, document, section_reference in zip(index_df["text"],
+                                                     index_df["document"] if has_document else [None] * len(index_df),
+                                                     index_df["section_reference"]):
+        if document is not None and (document, section_reference) not in section_content:
+            section_content[(document, section_reference)] = corpus.get_text(document, section_reference, add_markdown_decorators = False, add_headings = True, section_only = True)
+        texts.append(row_text + "\n" + section_content.get((document, section_reference), ""))
+    return texts
+
+
+def build_sparse_index(index_df, corpus):
+    start = time.perf_counter()
+    sparse_index = BM25Index(sparse_texts(index_df, corpus))
+    logger.log(DEV_LEVEL, f"Built the sparse index over {len(index_df)} rows in {time.perf_counter() - start:.3f}s")
+    return sparse_index
+
+
+def save_sparse_index(sparse_index, folder, version):
+    path = os.path.join(folder, sparse_index_file_name)
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, version = np.array(version), **sparse_index.to_arrays())
+    os.replace(tmp_path, path)
+
+
+def load_sparse_index(folder, version):
+    '''
+    Returns the sparse index saved in folder for this index version, or None if there is none
+    '''
+    path = os.path.join(folder, sparse_index_file_name)
+    if not os.path.isfile(path):
+        return None
+    with np.load(path) as arrays:
+        if str(arrays["version"]) != version:
+            logger.warning(f"Ignoring the sparse index in {folder}. It was built for index version {arrays['version']}, not {version}")
+            return None
+        return BM25Index.from_arrays({name: arrays[name] for name in arrays.files})
+
+
+def reciprocal_rank_fusion(rankings, k = default_rrf_k):
+    '''
+    Fuses several rankings (arrays of row positions, best first) into one: each row scores the sum of
+    1 / (k + rank) over the rankings it appears in. Returns (positions, scores), best first
+    '''
+    scores = {}
+    for ranking in rankings:
+        for rank, position in enumerate(ranking):
+            scores[position] = scores.get(position, 0.0) + 1.0 / (k + rank + 1)
+    positions = np.array(sorted(scores, key = lambda position: -scores[position]), dtype = np.int64)
+    return positions, np.array([scores[position] for position in positions], dtype = np.float32)
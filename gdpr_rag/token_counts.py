@@ -0,0 +1,95 @@
+import logging
+import threading
+
+import numpy as np
+import tiktoken
+from cachetools import LRUCache
+
+logger = logging.getLogger(__name__)
+ANALYSIS_LEVEL = 25
+logging.addLevelName(ANALYSIS_LEVEL, 'ANALYSIS')
+
+# The encoding used by gpt-4o
+default_encoding_name = "o200k_base"
+default_maxsize = 16384
+
+
+class TokenCounter:
+    '''
+    Process-wide, memoised tiktoken counts. The same GDPR sections and chat messages are counted on every turn
+    of every session, so each distinct text is only encoded once (until it drops out of the LRU cache).
+    '''
+    def __init__(self, encoding_name = default_encoding_name, maxsize = default_maxsize):
+        self.encoding_name = encoding_name
+        self._encoding = None
+        self._cache = LRUCache(maxsize = maxsize)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def encoding(self):
+        # Loaded on first use: tiktoken fetches the encoding file the first time it is used on a machine
+        if self._encoding is None:
+            self._encoding = tiktoken.get_encoding(self.encoding_name)
+        return self._encoding
+
+    def count(self, text, memoise = True):
+        '''
+        Pass memoise = False for text that is not going to be counted again, like a prompt with the retrieved sections
+        in it, so it does not take the place of the texts the cache is for
+        '''
+        if not memoise:
+            return len(self.encoding.encode(text, disallowed_special = ()))
+        with self._lock:
+            count = self._cache.get(text)
+            if count is not None:
+                self.hits += 1
+                return count
+            self.misses += 1
+        count = len(self.encoding.encode(text, disallowed_special = ()))
+        with self._lock:
+            self._cache[text] = count
+        return count
+
+    def count_all(self, texts):
+        '''
+        Counts for a batch of texts that are each only counted once, e.g. when the index is built. Not memoised
+        '''
+        return np.array([len(tokens) for tokens in self.encoding.encode_batch(list(texts), disallowed_special = ())], dtype = np.int32)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "size": len(self._cache),
+                    "maxsize": self._cache.maxsize}
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.log(ANALYSIS_LEVEL, f"Token counts: {stats['hits']} hits, {stats['misses']} misses, hit rate {stats['hit_rate']:.1%}, {stats['size']}/{stats['maxsize']} entries")
+
+
+token_counter = TokenCounter()
+
+
+def rendered_section_text(corpus, document, section_reference):
+    # Meant to match how regulations_rag renders a section into the prompt. The counts made from it are only used to
+    # plan (the BM25 rerank); GDPRCorpusIndex.cap_rag_section_token_length counts the actual prompt text
+    return corpus.get_text(document, section_reference, add_markdown_decorators = False, add_headings = True, section_only = False)
+
+
+def add_token_counts(index_df, corpus):
+    '''
+    Adds the column 'section_token_count' (tokens in the document section the row points to, as rendered_section_text
+    renders it) so it can be stored in the index artifact
+    '''
+    index_df = index_df.copy()
+    if "document" in index_df.columns:
+        sections = index_df[["document", "section_reference"]].drop_duplicates()
+        texts = [rendered_section_text(corpus, document, section_reference) for document, section_reference in sections.itertuples(index = False, name = None)]
+        counts = dict(zip(sections.itertuples(index = False, name = None), token_counter.count_all(texts)))
+        index_df["section_token_count"] = [counts[key] for key in index_df[["document", "section_reference"]].itertuples(index = False, name = None)]
+    return index_df
@@ -0,0 +1,236 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+DEV_LEVEL = 15
+logging.addLevelName(DEV_LEVEL, 'DEV')
+
+
+def _normalise(matrix):
+    matrix = np.array(matrix, dtype = np.float32, ndmin = 2)
+    norms = np.linalg.norm(matrix, axis = 1, keepdims = True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _root(array):
+    while isinstance(array, np.ndarray) and array.base is not None:
+        array = array.base
+    return array
+
+
+def _as_matrix(rows):
+    '''
+    The rows as one (n, dimensions) float32 matrix. When they are evenly spaced views into one buffer, like the rows of
+    the memory-mapped index artifact or shared index, this is a read-only view of that buffer and nothing is copied
+    '''
+    if len(rows) == 0:
+        return np.zeros((0, 0), dtype = np.float32)
+    first = rows[0]
+    if all(isinstance(row, np.ndarray) and row.dtype == np.float32 and row.shape == first.shape and row.ndim == 1 and row.flags.c_contiguous for row in rows):
+        addresses = np.array([row.__array_interface__["data"][0] for row in rows], dtype = np.int64)
+        stride = int(addresses[1] - addresses[0]) if len(rows) > 1 else first.nbytes
+        root = _root(first)
+        if stride >= first.nbytes and np.array_equal(np.diff(addresses), np.full(len(rows) - 1, stride)) and all(_root(row) is root for row in rows):
+            return np.lib.stride_tricks.as_strided(first, shape = (len(rows), first.shape[0]), strides = (stride, first.itemsize), writeable = False)
+    return np.array(rows, dtype = np.float32, ndmin = 2)
+
+
+def cosine_distances(rows, query_embedding):
+    '''
+    Cosine distance between query_embedding and each of rows
+    '''
+    if len(rows) == 0:
+        return np.zeros(0, dtype = np.float32)
+    return 1.0 - _normalise(rows) @ _normalise(query_embedding)[0]
+
+
+def _spherical_kmeans(matrix, n_clusters, iterations = 10, seed = 0):
+    '''
+    k-means on unit vectors using cosine similarity. Each iteration is one matrix product so it stays fast for
+    1024 dimensional embeddings. Returns (unit length centroids, label of each row)
+    '''
+    rng = np.random.default_rng(seed)
+    centroids = matrix[rng.choice(matrix.shape[0], size = n_clusters, replace = False)]
+    for _ in range(iterations):
+        labels = np.argmax(matrix @ centroids.T, axis = 1)
+        # sum the rows of each cluster: sort by label and add up each run of equal labels
+        order = np.argsort(labels, kind = "stable")
+        occupied, starts = np.unique(labels[order], return_index = True)
+        sums = np.add.reduceat(matrix[order], starts, axis = 0)
+        # an empty cluster keeps its old centroid
+        centroids[occupied] = _normalise(sums)
+    labels = np.argmax(matrix @ centroids.T, axis = 1)
+    return centroids, labels
+
+
+class ExactVectorIndex():
+    '''
+    Brute force cosine search over a float32 matrix: one matrix-vector product per question. The rows are searched
+    where they are, so a memory-mapped artifact or shared index is not copied. Rows that are not unit length (OpenAI
+    embeddings are) are handled by dividing the products by the row norms.
+
+    search() returns the positions (rows of the matrix the index was built from) with a cosine distance
+    below the threshold, closest first, together with those distances.
+    '''
+    def __init__(self, embeddings):
+        self.embeddings = _as_matrix(embeddings)
+        norms = np.sqrt(np.einsum('ij,ij->i', self.embeddings, self.embeddings))
+        norms[norms == 0] = 1.0
+        self.inverse_norms = None if np.allclose(norms, 1.0, rtol = 0, atol = 1e-5) else (1.0 / norms).astype(np.float32)
+
+    def __len__(self):
+        return self.embeddings.shape[0]
+
+    def _distances(self, candidates, query):
+        similarities = self.embeddings[candidates] @ query
+        if self.inverse_norms is not None:
+            similarities *= self.inverse_norms[candidates]
+        return 1.0 - similarities
+
+    def _rank(self, candidates, query, threshold, distances = None):
+        if distances is None:
+            distances = self._distances(candidates, query)
+        keep = distances < threshold
+        candidates, distances = candidates[keep], distances[keep]
+        order = np.argsort(distances, kind = "stable")
+        return candidates[order], distances[order]
+
+    def search(self, query_embedding, threshold):
+        if len(self) == 0:
+            return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.float32)
+        query = _normalise(query_embedding)[0]
+        similarities = self.embeddings @ query
+        if self.inverse_norms is not None:
+            similarities *= self.inverse_norms
+        return self._rank(np.arange(len(self)), query, threshold, distances = 1.0 - similarities)
+
+
+class IVFVectorIndex(ExactVectorIndex):
+    '''
+    Inverted file index: the rows are clustered with k-means once at build time and a question is only compared
+    with the rows in the n_probe clusters whose centroids are closest to it. n_probe is the recall / latency knob:
+    n_probe = n_lists is an exact search, smaller values look at roughly n_probe / n_lists of the rows.
+    '''
+    def __init__(self, embeddings, n_lists = None, n_probe = 8, seed = 0):
+        super().__init__(embeddings)
+        if len(self) == 0:
+            self.centroids = np.zeros((0, 0), dtype = np.float32)
+            self.lists = []
+        else:
+            n_lists = min(n_lists or max(1, int(np.sqrt(len(self)))), len(self))
+            unit_rows = self.embeddings if self.inverse_norms is None else self.embeddings * self.inverse_norms[:, None]
+            self.centroids, labels = _spherical_kmeans(unit_rows, n_lists, seed = seed)
+            self.lists = [np.flatnonzero(labels == i) for i in range(n_lists)]
+        self.n_probe = n_probe
+        logger.log(DEV_LEVEL, f"Built an IVF index over {len(self)} rows with {len(self.lists)} lists")
+
+    def search(self, query_embedding, threshold, n_probe = None):
+        if len(self) == 0:
+            return super().search(query_embedding, threshold)
+        query = _normalise(query_embedding)[0]
+        n_probe = min(n_probe or self.n_probe, len(self.lists))
+        probe = np.argsort(-(self.centroids @ query))[:n_probe]
+        candidates = np.sort(np.concatenate([self.lists[i] for i in probe]))
+        return self._rank(candidates, query, threshold)
+
+
+class Int8VectorIndex():
+    '''
+    Keeps an int8 copy of the unit length embeddings (a quarter of the float32 size) for the first pass and rescores
+    the shortlist against the original full precision rows, which are never copied. When those rows are views into
+    the memory-mapped index artifact only the shortlisted rows are ever read.
+
+    Each row stores the norm of its own quantisation error, which bounds how far its int8 similarity can be from the
+    true one. Every row that could be under the threshold is shortlisted, so the result is the same as an exact search.
+    '''
+    def __init__(self, embeddings, chunk_size = 4096):
+        self.full_precision = embeddings
+        self.chunk_size = chunk_size
+        codes, scales, errors = [], [], []
+        for start in range(0, len(embeddings), chunk_size):
+            chunk = _normalise(embeddings[start:start + chunk_size])
+            scale = np.abs(chunk).max(axis = 1, keepdims = True) / 127.0
+            scale[scale == 0] = 1.0
+            chunk_codes = np.round(chunk / scale).astype(np.int8)
+            codes.append(chunk_codes)
+            scales.append(scale[:, 0])
+            errors.append(np.linalg.norm(chunk - chunk_codes * scale, axis = 1))
+        dimensions = len(embeddings[0]) if len(embeddings) else 0
+        self.codes = np.concatenate(codes) if codes else np.zeros((0, dimensions), dtype = np.int8)
+        self.scales = np.concatenate(scales).astype(np.float32) if scales else np.zeros(0, dtype = np.float32)
+        self.errors = np.concatenate(errors).astype(np.float32) if errors else np.zeros(0, dtype = np.float32)
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def search(self, query_embedding, threshold):
+        if len(self) == 0:
+            return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.float32)
+        query = _normalise(query_embedding)[0]
+        shortlist = []
+        for start in range(0, len(self), self.chunk_size):
+            stop = start + self.chunk_size
+            # einsum avoids materialising a float copy of the chunk, which is what the int8 @ float32 product does
+            approximate_distances = 1.0 - np.einsum('ij,j->i', self.codes[start:stop], query) * self.scales[start:stop]
+            shortlist.append(start + np.flatnonzero(approximate_distances - self.errors[start:stop] < threshold))
+        candidates = np.concatenate(shortlist)
+        if len(candidates) == 0:
+            return candidates, np.zeros(0, dtype = np.float32)
+
+        full_precision = _normalise([self.full_precision[i] for i in candidates])
+        distances = 1.0 - full_precision @ query
+        keep = distances < threshold
+        candidates, distances = candidates[keep], distances[keep]
+        order = np.argsort(distances, kind = "stable")
+        return candidates[order], distances[order]
+
+
+class TruncatedVectorIndex():
+    '''
+    Two stage search for embeddings trained to stay meaningful when truncated (text-embedding-3-*). The first
+    coarse_dimensions of every row are searched first. The n_candidates closest rows, plus any row whose coarse distance
+    is within coarse_margin of the threshold, are then rescored with the full embedding and the usual threshold applied.
+
+    The coarse pass is not a bound on the full distance, so unlike "int8" this can miss rows. n_candidates and
+    coarse_margin trade recall for latency; gdpr_rag/retrieval_benchmark.py measures both against "exact".
+    '''
+    def __init__(self, embeddings, coarse_dimensions = 256, n_candidates = 200, coarse_margin = 0.1):
+        self.full_precision = _normalise(embeddings) if len(embeddings) else np.zeros((0, 0), dtype = np.float32)
+        self.coarse = _normalise(self.full_precision[:, :coarse_dimensions]) if len(embeddings) else self.full_precision
+        self.n_candidates = n_candidates
+        self.coarse_margin = coarse_margin
+
+    def __len__(self):
+        return self.full_precision.shape[0]
+
+    def search(self, query_embedding, threshold):
+        if len(self) == 0:
+            return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.float32)
+        query = _normalise(query_embedding)[0]
+        coarse_distances = 1.0 - self.coarse @ _normalise(query[:self.coarse.shape[1]])[0]
+        n_candidates = min(self.n_candidates, len(self))
+        nearest = np.argpartition(coarse_distances, n_candidates - 1)[:n_candidates]
+        within_margin = np.flatnonzero(coarse_distances < threshold + self.coarse_margin)
+        candidates = np.union1d(nearest, within_margin)
+
+        distances = 1.0 - self.full_precision[candidates] @ query
+        keep = distances < threshold
+        candidates, distances = candidates[keep], distances[keep]
+        order = np.argsort(distances, kind = "stable")
+        return candidates[order], distances[order]
+
+
+vector_backends = {
+    "exact": ExactVectorIndex,
+    "ivf": IVFVectorIndex,
+    "int8": Int8VectorIndex,
+    "truncated": TruncatedVectorIndex,
+}
+
+
+def create_vector_index(embeddings, backend = "exact", **params):
+    if backend not in vector_backends:
+        raise ValueError(f"Unknown vector index backend {backend}. Use one of {list(vector_backends.keys())}")
+    return vector_backends[backend](embeddings, **params)
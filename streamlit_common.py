@@ -1,20 +1,27 @@
 import logging
 import os
-from openai import OpenAI
+import httpx
+from openai import OpenAI, DefaultHttpxClient
 import platform
 import bcrypt
 from dotenv import load_dotenv
 
 import streamlit as st
 
-from azure.storage.blob import BlobServiceClient, ContentSettings
+from azure.core.exceptions import ResourceExistsError
+from azure.storage.blob import BlobServiceClient
 
 from regulations_rag.rerank import RerankAlgos
 from regulations_rag.corpus_chat import ChatParameters
 from regulations_rag.embeddings import  EmbeddingParameters
 
 from gdpr_rag.corpus_index import GDPRCorpusIndex
-from regulations_rag.corpus_chat import CorpusChat
+from gdpr_rag.embedding_cache import EmbeddingCache, CachedEmbeddingsClient, default_embedding_cache_path
+from gdpr_rag.answer_cache import AnswerCache
+from gdpr_rag.corpus_chat import GDPRCorpusChat
+from gdpr_rag.lexical_rerank import BM25Rerank
+from gdpr_rag.openai_scheduler import RequestScheduler, ScheduledOpenAIClient, default_max_in_flight
+from blob_writer import BlobLogWriter, LogFileShipper
 
 DEV_LEVEL = 15
 ANALYSIS_LEVEL = 25
@@ -39,37 +46,26 @@ def _get_blog_container():
     # Get the container client
     container_client = blob_service_client.get_container_client(st.session_state['blob_container_name'])
 
-    # Check if the container exists, and create it if it doesn't
-    if not container_client.exists():
+    # Create the container if it doesn't exist. One round trip, once per process
+    try:
         container_client.create_container()
+    except ResourceExistsError:
+        pass
 
     return container_client
 
+# One shipper per process: it remembers how much of the local log file is already in blob storage.
+# The global log blob is created by the shipper's thread
 @st.cache_resource
-def _get_blob_for_global_logging(filename):
-    container_client = _get_blog_container()
-    blob_client = container_client.get_blob_client(filename)
-    
-    blob_exists = blob_client.exists()
-    if not blob_exists:
-        with open(st.session_state['global_logging_file_name'], "rb") as temp_file:
-            container_client.upload_blob(name=filename, data=temp_file, content_settings=ContentSettings(content_type='text/plain'))
-    return blob_client
+def _get_global_log_shipper(filename, logging_file_name):
+    return LogFileShipper(logging_file_name, _get_blog_container().get_blob_client(filename))
 
 
 # summary data for analysis is sent to individual files per session
 # https://stackoverflow.com/questions/77600048/azure-function-logging-to-azure-blob-with-python
 def _get_blob_for_session_data_logging(filename):
-    container_client = _get_blog_container()
-
-    blob_client = container_client.get_blob_client(filename)
-    # Check if blob exists, if not create an append blob
-    try:
-        blob_client.get_blob_properties()  # Check if blob exists
-    except:
-        # Create an empty append blob if it doesn't exist
-        blob_client.create_append_blob()
-    return blob_client
+    # No round trip here: the append blob is created by the blob log writer when it first writes to it
+    return _get_blog_container().get_blob_client(filename)
 
 
 
@@ -164,14 +160,56 @@ def setup_log_storage(filename):
                 st.session_state['blob_container_name'] = os.getenv('BLOB_CONTAINER', 'gdprtest01') # set a default in case 'BLOB_CONTAINER' is not set
                 st.session_state['blob_store_key'] = os.getenv("CHAT_BLOB_STORE")
                 st.session_state['blob_client_for_session_data'] = _get_blob_for_session_data_logging(filename)
-                st.session_state['blob_name_for_global_logs'] = "app_log_data.txt"
-                st.session_state['blob_client_for_global_data'] = _get_blob_for_global_logging(st.session_state['blob_name_for_global_logs'])
+                _get_blob_log_writer().log_stats()
+                # app_log_data.txt is the block blob that older versions overwrote. It is left as it is
+                st.session_state['blob_name_for_global_logs'] = "app_log_data_appended.txt"
+                st.session_state['global_log_shipper'] = _get_global_log_shipper(st.session_state['blob_name_for_global_logs'], st.session_state['global_logging_file_name'])
+                st.session_state['global_log_shipper'].log_stats()
 
 
 @st.cache_resource
 def load_gdpr_corpus_index(key):
     logger.log(ANALYSIS_LEVEL, f"*** Loading gdpr corpis index. This should only happen once")
-    return GDPRCorpusIndex(key)
+    # Documents are only parsed when they are first cited or the Table of Content page is opened
+    # SHARED_INDEX=true lets all the app processes on one host share a single memory-mapped copy of the index
+    shared_memory = os.getenv("SHARED_INDEX", "false").lower() == "true"
+    # HYBRID_SEARCH=true fuses the embedding search with a BM25 search so exact terms and article numbers are found
+    hybrid_search = os.getenv("HYBRID_SEARCH", "false").lower() == "true"
+    return GDPRCorpusIndex(key, lazy_corpus = True, shared_memory = shared_memory, hybrid_search = hybrid_search)
+
+@st.cache_resource
+def load_embedding_cache():
+    # Repeat questions skip the embeddings API. The cache file outlives the process so it also survives restarts
+    return EmbeddingCache(os.getenv("EMBEDDING_CACHE_PATH", default_embedding_cache_path))
+
+@st.cache_resource
+def load_answer_cache():
+    # Shared by all sessions. Answers are only reused because the chat runs with temperature = 0
+    return AnswerCache()
+
+@st.cache_resource
+def load_openai_client(api_key):
+    # One client, with one pool of keep-alive connections, for every session in the process. Every call goes
+    # through a scheduler that caps the calls in flight (OPENAI_MAX_IN_FLIGHT) and, if OPENAI_TOKENS_PER_MINUTE is
+    # set, the tokens per minute, and retries 429s, connection errors, timeouts and 5xx responses with backoff.
+    # Repeat question embeddings never reach it
+    max_in_flight = int(os.getenv("OPENAI_MAX_IN_FLIGHT", default_max_in_flight))
+    tokens_per_minute = int(os.getenv("OPENAI_TOKENS_PER_MINUTE", "0")) or None
+    http_client = DefaultHttpxClient(limits = httpx.Limits(max_connections = 2 * max_in_flight, max_keepalive_connections = max_in_flight))
+    client = OpenAI(api_key = api_key, max_retries = 0, http_client = http_client)
+    scheduler = RequestScheduler(max_in_flight = max_in_flight, tokens_per_minute = tokens_per_minute)
+    return CachedEmbeddingsClient(ScheduledOpenAIClient(client, scheduler), load_embedding_cache())
+
+@st.cache_resource
+def load_llm_rerank(api_key, model_to_use, user_type, corpus_description):
+    # RerankAlgos.LLM is a module level object shared by every session, so it is configured once per process
+    rerank_algo = RerankAlgos.LLM
+    rerank_algo.params["openai_client"] = load_openai_client(api_key)
+    rerank_algo.params["model_to_use"] = model_to_use
+    rerank_algo.params["user_type"] = user_type
+    rerank_algo.params["corpus_description"] = corpus_description
+    rerank_algo.params["final_token_cap"] = 5000 # can go large with the new models
+    return rerank_algo
 
 def load_data():
     with st.spinner(text="Loading the excon documents and index - hang tight! This should take 5 seconds."):
@@ -179,32 +217,41 @@ def load_data():
         corpus_index = load_gdpr_corpus_index(st.session_state['corpus_decryption_key'])
         model_to_use =  "gpt-4o"
         chat_parameters = ChatParameters(chat_model = model_to_use, api_key=st.session_state['openai_key'], temperature = 0, max_tokens = 500, token_limit_when_truncating_message_queue = 3500)
-
-        rerank_algo = RerankAlgos.LLM
-        rerank_algo.params["openai_client"] = chat_parameters.openai_client
-        rerank_algo.params["model_to_use"] = model_to_use
-        rerank_algo.params["user_type"] = corpus_index.user_type
-        rerank_algo.params["corpus_description"] = corpus_index.corpus_description
-        rerank_algo.params["final_token_cap"] = 5000 # can go large with the new models
+        # ChatParameters makes a client of its own. Close it (and its connection pool) and use the shared one instead
+        chat_parameters.openai_client.close()
+        chat_parameters.openai_client = load_openai_client(st.session_state['openai_key'])
+        chat_parameters.openai_client.scheduler.log_stats()
+
+        # RERANK=bm25 swaps the LLM rerank for a local lexical one (see gdpr_rag/lexical_rerank.py)
+        if os.getenv("RERANK", "llm").lower() == "bm25":
+            rerank_algo = BM25Rerank(final_token_cap = 5000)
+        else:
+            rerank_algo = load_llm_rerank(st.session_state['openai_key'], model_to_use, corpus_index.user_type, corpus_index.corpus_description)
 
         
-        chat = CorpusChat(
+        chat = GDPRCorpusChat(
                           embedding_parameters = embedding_parameters, 
                           chat_parameters = chat_parameters, 
                           corpus_index = corpus_index,
                           rerank_algo = rerank_algo,   
-                          user_name_for_logging=st.session_state["user_id"])
+                          user_name_for_logging=st.session_state["user_id"],
+                          answer_cache = load_answer_cache())
 
         return chat
 
 
+# One background writer per process so that appending to the session logs never blocks a page
+@st.cache_resource
+def _get_blob_log_writer():
+    return BlobLogWriter()
+
 def write_session_data_to_blob(text):
     if 'service_provider' in st.session_state and st.session_state['service_provider'] == 'azure':
         # Session log for user
-        st.session_state['blob_client_for_session_data'].append_block(text + "\n")
+        _get_blob_log_writer().append(st.session_state['blob_client_for_session_data'], text + "\n")
 
 def write_global_data_to_blob():
+    # Only hands over to the shipper's thread, which appends whatever was logged since the last time
     if 'service_provider' in st.session_state and st.session_state['service_provider'] == 'azure':
-        with open(st.session_state['global_logging_file_name'], "r") as temp_file:
-            content = temp_file.read()
-    st.session_state['blob_client_for_global_data'].upload_blob(data=content, overwrite=True)
+        if 'global_log_shipper' in st.session_state:
+            st.session_state['global_log_shipper'].ship()
@@ -5,6 +5,7 @@ import logging
 import uuid
 
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx
 import pandas as pd
 import json
 
@@ -46,6 +47,8 @@ def display_assistant_response(row, message_index):
     with col1:
         answer = row["content"]
         st.markdown(answer)
+        if row.get("from_cache", False):
+            st.caption("This answer was reused from an earlier answer to the same question")
         if "references" in row:
             references = row["references"]
             # references is a dataframe with columns = ["document_key", "document_name", "section_reference", "is_definition", "text"]
@@ -141,7 +144,20 @@ def make_call_to_chat(prompt):
     
     st.session_state['chat'].set_progress_callback(update_progress)
 
-    st.session_state['chat'].user_provides_input(prompt)
+    # Show the answer as it is generated. The pipeline runs on a worker thread, which needs the script context
+    # so the progress callback can still update the page
+    def answer_with_spinner(answer_stream):
+        with st.spinner("Thinking..."):
+            first_delta = next(answer_stream, None)
+        if first_delta is not None:
+            yield first_delta
+            yield from answer_stream
+
+    stream_placeholder = st.empty()
+    with stream_placeholder.container():
+        st.write_stream(answer_with_spinner(st.session_state['chat'].user_provides_input_streaming(prompt, prepare_thread = add_script_run_ctx)))
+    # The streamed text is the raw model output. Replace it with the formatted answer and its references
+    stream_placeholder.empty()
 
     raw_response = st.session_state['chat'].messages_intermediate[-1]
 
@@ -152,7 +168,7 @@ def make_call_to_chat(prompt):
     else:
         content = raw_response["assistant_response"].get_text_for_streamlit()
 
-    row_to_add_to_messages = {"role": "assistant", "content": content, "id": id}
+    row_to_add_to_messages = {"role": "assistant", "content": content, "id": id, "from_cache": raw_response.get("from_cache", False)}
     if isinstance(raw_response["assistant_response"], AnswerWithRAGResponse):
         row_to_add_to_messages["references"] = raw_response["assistant_response"].references
 
@@ -181,8 +197,7 @@ if prompt is not None and prompt != "":
     with st.chat_message("assistant"):
         llm_response_formatted_for_logs = ""
 
-        with st.spinner("Thinking..."):
-            make_call_to_chat(prompt)
+        make_call_to_chat(prompt)
 
     
 footer()
@@ -1,8 +1,3 @@
-import os
-import importlib.util
-import inspect
-
-
 import streamlit as st
 
 import streamlit_antd_components as sac
@@ -24,18 +19,6 @@ st.markdown('Want more documents included? Reach out to me on <a href="https://w
 st.markdown("---")
     
 
-def load_class_from_file(filepath):
-    spec = importlib.util.spec_from_file_location("module.name", filepath)
-    module = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(module)
-    
-    # Find the class that is not abstract
-    for name, obj in inspect.getmembers(module, inspect.isclass):
-        if obj.__module__ == module.__name__ and not inspect.isabstract(obj):
-            return obj
-    raise ValueError(f"No suitable class found in {filepath}")
-
-
 # Function to add a property to every node in the tree
 def add_property_to_all_nodes(root, property_name, property_value):
     for node in PreOrderIter(root):
@@ -61,59 +44,46 @@ def anytree_to_treeitem(node):
 
 
 
+# The documents are already loaded in the corpus so build the tree from those instances rather than loading them again
 @st.cache_resource
-def load_tree_data():
-    date_ordered_list_of_documents = ['gdpr.py', 'article_30_5.py', 'article_47_bcr.py', 'decision_making.py', 'dpia.py', 'dpo.py', 'article_49_intl_transfer.py',
-                                    'lead_sa.py', 'data_breach.py', 'data_portability.py', 'transparency.py', 'codes.py', 'online_services.py', 'territorial_scope.py',
-                                    'video.py', 'covid_health.py', 'covid_location.py', 'consent.py', 'forgotten.py', 'protection.py']
-
-
-    input_folder = './gdpr_rag/documents/'
+def load_tree_data(_corpus):
+    date_ordered_list_of_documents = ['GDPR', 'Article_30_5', 'Article_47_BCR', 'DecisionMaking', 'DPIA', 'DPO', 'Article_49_Intl_Transfer',
+                                    'Lead_SA', 'DataBreach', 'DataPortability', 'Transparency', 'Codes', 'OnlineServices', 'TerritorialScope',
+                                    'Video', 'CovidHealth', 'CovidLocation', 'Consent', 'Forgotten', 'Protection']
 
     combined_toc = Node("Corpus")
 
-    for filename in date_ordered_list_of_documents:
-        filepath = os.path.join(input_folder, filename)
-        Class = load_class_from_file(filepath)
-        instance = Class()
-        toc = instance.get_toc()
-        class_name = Class.__name__
-        add_property_to_all_nodes(toc.root, 'document', class_name)
+    for document_key in date_ordered_list_of_documents:
+        # get_toc() builds a new tree so attaching it to combined_toc does not change the toc held by the document
+        toc = _corpus.get_document(document_key).get_toc()
+        add_property_to_all_nodes(toc.root, 'document', document_key)
         toc.root.parent = combined_toc
 
     sac_tree = anytree_to_treeitem(combined_toc.root)
+    # sac.tree returns the pre-order index of the selected item so keep the nodes in that order for direct lookup
+    nodes_in_pre_order = list(PreOrderIter(combined_toc))
     # Display the tree using sac.tree
-    return combined_toc, sac_tree
-
+    return combined_toc, sac_tree, nodes_in_pre_order
 
-def find_nth_item(tree_item, n):
-    def traverse_tree(item, count):
-        if count[0] == n:
-            return item
-        count[0] += 1
-        for child in item.children:
-            result = traverse_tree(child, count)
-            if result:
-                return result
-        return None
-    return traverse_tree(tree_item, [0])
 
 def get_text_for_node(node_number):
-    combined_toc = st.session_state['tree_data']
-    anytree_node = find_nth_item(combined_toc, node_number)
-    
-    if hasattr(find_nth_item(combined_toc, node_number), "full_node_name"):
-        node = find_nth_item(combined_toc, node_number)
+    nodes_in_pre_order = st.session_state['tree_nodes']
+    if not isinstance(node_number, int) or not 0 <= node_number < len(nodes_in_pre_order):
+        return "No selection to display yet"
+
+    node = nodes_in_pre_order[node_number]
+    if hasattr(node, "full_node_name"):
         return st.session_state['chat'].corpus.get_document(node.document).get_text(node.full_node_name, add_markdown_decorators = True, add_headings = True, section_only = False)
     else:
         return "No selection to display yet"
 
 
 
-if 'tree' not in st.session_state:    
-    anytree_toc, sac_tree_data = load_tree_data()
+if 'tree_nodes' not in st.session_state:    
+    anytree_toc, sac_tree_data, nodes_in_pre_order = load_tree_data(st.session_state['chat'].index.corpus)
     st.session_state['tree'] = sac_tree_data
     st.session_state['tree_data'] = anytree_toc
+    st.session_state['tree_nodes'] = nodes_in_pre_order
 
 selected = sac.tree(items=[st.session_state['tree']], label='Included Documents', size='md', return_index=True)
 
@@ -0,0 +1,77 @@
+import threading
+import types
+
+import pytest
+
+pytest.importorskip("regulations_rag")
+
+from gdpr_rag.corpus_chat import _ConcurrentRetrieval
+
+
+class RecordingIndex:
+    def __init__(self, barrier = None):
+        self.calls = []
+        self._lock = threading.Lock()
+        # definitions and sections both wait on it when given, so they only get through if they run at the same time
+        self._barrier = barrier
+
+    def _record(self, stage):
+        with self._lock:
+            self.calls.append(stage)
+        return stage
+
+    def get_relevant_definitions(self, user_content, user_content_embedding, threshold):
+        if self._barrier is not None:
+            self._barrier.wait()
+        return self._record("definitions")
+
+    def get_relevant_sections(self, user_content, user_content_embedding, threshold, rerank_algo = None):
+        if self._barrier is not None:
+            self._barrier.wait()
+        return self._record("sections")
+
+    def get_relevant_workflow(self, user_content_embedding, threshold):
+        return self._record("workflow")
+
+
+def make_retrieval(barrier = None):
+    index = RecordingIndex(barrier)
+    chat = types.SimpleNamespace(embedding_parameters = types.SimpleNamespace(threshold = 0.5, threshold_definitions = 0.3),
+                                 rerank_algo = "llm")
+    return index, _ConcurrentRetrieval(index, chat)
+
+
+def test_sections_are_not_looked_up_when_not_asked_for():
+    index, retrieval = make_retrieval()
+    retrieval.begin_question("question")
+    assert retrieval.get_relevant_definitions("question", [1.0, 0.0], 0.3) == "definitions"
+    assert retrieval.get_relevant_workflow([1.0, 0.0], 0.5) == "workflow"
+    retrieval.finish_question()
+    assert "sections" not in index.calls
+
+
+def test_workflow_first_starts_the_definitions_lookup():
+    index, retrieval = make_retrieval()
+    retrieval.begin_question("question")
+    assert retrieval.get_relevant_workflow([1.0, 0.0], 0.5) == "workflow"
+    assert retrieval.get_relevant_definitions("question", [1.0, 0.0], 0.3) == "definitions"
+    retrieval.finish_question()
+    assert sorted(index.calls) == ["definitions", "workflow"]
+
+
+def test_each_stage_runs_once_when_all_are_asked_for():
+    index, retrieval = make_retrieval()
+    retrieval.begin_question("question")
+    retrieval.get_relevant_definitions("question", [1.0, 0.0], 0.3)
+    assert retrieval.get_relevant_sections("question", [1.0, 0.0], 0.5, "llm") == "sections"
+    retrieval.get_relevant_workflow([1.0, 0.0], 0.5)
+    retrieval.finish_question()
+    assert sorted(index.calls) == ["definitions", "sections", "workflow"]
+
+
+def test_definitions_and_sections_run_at_the_same_time():
+    index, retrieval = make_retrieval(threading.Barrier(2, timeout = 5))
+    retrieval.begin_question("question")
+    assert retrieval.definitions_and_sections("question", [1.0, 0.0]) == ("definitions", "sections")
+    retrieval.finish_question()
+    assert index.calls.count("definitions") == 1 and index.calls.count("sections") == 1
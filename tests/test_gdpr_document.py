@@ -0,0 +1,66 @@
+import hashlib
+import json
+import os
+import re
+
+import pytest
+
+pytest.importorskip("regulations_rag")
+
+from gdpr_rag.documents.gdpr import GDPR
+
+# get_text and get_heading of the GDPR implementation before it was optimised, for every reference in gdpr.csv and
+# every parent of one. Written by running this file (python tests/test_gdpr_document.py) from a checkout of that version
+baseline_path = os.path.join(os.path.dirname(__file__), "data", "gdpr_baseline.json")
+
+flag_combinations = [(add_markdown_decorators, add_headings) for add_markdown_decorators in (False, True) for add_headings in (False, True)]
+
+
+def all_references(gdpr):
+    references = set()
+    for section_reference in gdpr.document_as_df["section_reference"]:
+        parts = re.findall(r'\d+|\([^)]*\)', section_reference)
+        references.update("".join(parts[:i + 1]) for i in range(len(parts)))
+    return sorted(references)
+
+
+def _digest(text):
+    # get_text of a whole article is long, so only a hash of it is stored
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def snapshot(gdpr):
+    result = {"": {"heading": gdpr.get_heading("")}}
+    for reference in all_references(gdpr):
+        entry = {"heading": gdpr.get_heading(reference)}
+        for add_markdown_decorators, add_headings in flag_combinations:
+            text = gdpr.get_text(reference, add_markdown_decorators = add_markdown_decorators, add_headings = add_headings)
+            entry[f"text|{add_markdown_decorators}|{add_headings}"] = _digest(text)
+        result[reference] = entry
+    return result
+
+
+@pytest.fixture(scope = "module")
+def gdpr():
+    return GDPR()
+
+
+def test_heading_of_the_empty_reference_is_the_first_article(gdpr):
+    # "" selects the whole document, so the heading is the one of its first row
+    assert gdpr.get_heading("") == gdpr.get_heading("1")
+    assert gdpr.get_heading("") != ""
+
+
+def test_text_and_headings_match_the_baseline(gdpr):
+    with open(baseline_path, "r", encoding = "utf-8") as file:
+        baseline = json.load(file)
+    current = snapshot(gdpr)
+    assert sorted(current) == sorted(baseline)
+    different = [reference for reference in baseline if current[reference] != baseline[reference]]
+    assert different == []
+
+
+if __name__ == "__main__":
+    os.makedirs(os.path.dirname(baseline_path), exist_ok = True)
+    with open(baseline_path, "w", encoding = "utf-8") as file:
+        json.dump(snapshot(GDPR()), file, indent = 1, sort_keys = True)